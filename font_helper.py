@@ -4,13 +4,44 @@
 # https://www.cairographics.org/cookbook/freetypepython/
 
 import ctypes as ct
+import os
+import threading
 import cairo
 
 _initialized = False
-def create_cairo_font_face_for_file (filename, faceindex=0, loadoptions=0):
+
+# The font file contents of the FreeType faces made from memory, keyed by
+# the address of their FT_Face, which must live as long as the face does.
+_memory_face_data = {}
+# NOTE: Reentrant, since cairo may destroy a face whenever a reference to it
+# goes away.
+_memory_face_data_lock = threading.RLock()
+
+# The cairo destroy hook of a face made from memory: done with the FT_Face
+# first, and only then with the memory it was made from.
+@ct.CFUNCTYPE(None, ct.c_void_p)
+def _done_memory_face(ft_face):
+	_freetype_so.FT_Done_Face(ct.c_void_p(ft_face))
+	with _memory_face_data_lock:
+		_memory_face_data.pop(ft_face, None)
+	#end with
+#end _done_memory_face
+
+# How many FreeType faces made from memory cairo hasn't destroyed yet.
+def live_memory_faces():
+	with _memory_face_data_lock:
+		return len(_memory_face_data)
+	#end with
+#end live_memory_faces
+
+def create_cairo_font_face_for_file (filename, faceindex=0, loadoptions=0, \
+		data=None):
 	"given the name of a font file, and optional faceindex to pass to FT_New_Face" \
 	" and loadoptions to pass to cairo_ft_font_face_create_for_ft_face, creates" \
-	" a cairo.FontFace object that may be used to render text with that font."
+	" a cairo.FontFace object that may be used to render text with that font." \
+	" If data is given, it is the contents of the font file, and the face is" \
+	" made from a copy of it with FT_New_Memory_Face instead, so it doesn't" \
+	" matter what happens to the file afterwards."
 	global _initialized
 	global _freetype_so
 	global _cairo_so
@@ -34,6 +65,7 @@ def create_cairo_font_face_for_file (filename, faceindex=0, loadoptions=0):
 		_cairo_so.cairo_font_face_status.argtypes = [ ct.c_void_p ]
 		_cairo_so.cairo_font_face_destroy.argtypes = (ct.c_void_p,)
 		_cairo_so.cairo_status.argtypes = [ ct.c_void_p ]
+		_freetype_so.FT_New_Memory_Face.argtypes = [ ct.c_void_p, ct.c_void_p, ct.c_long, ct.c_long, ct.c_void_p ]
 		# initialize freetype
 		_ft_lib = ct.c_void_p()
 		status = _freetype_so.FT_Init_FreeType(ct.byref(_ft_lib))
@@ -57,9 +89,17 @@ def create_cairo_font_face_for_file (filename, faceindex=0, loadoptions=0):
 
 	ft_face = ct.c_void_p()
 	cr_face = None
+	face_data = None
+	destroy_func = _freetype_so.FT_Done_Face
 	try :
 		# load FreeType face
-		status = _freetype_so.FT_New_Face(_ft_lib, filename.encode("utf-8"), faceindex, ct.byref(ft_face))
+		if data is None:
+			status = _freetype_so.FT_New_Face(_ft_lib, filename.encode("utf-8"), faceindex, ct.byref(ft_face))
+		else:
+			face_data = (ct.c_ubyte * len(data)).from_buffer_copy(data)
+			status = _freetype_so.FT_New_Memory_Face(_ft_lib, face_data, len(data), faceindex, ct.byref(ft_face))
+			destroy_func = _done_memory_face
+		#end if
 		if status != FT_Err_Ok :
 			raise RuntimeError("Error %d creating FreeType font face for %s" % (status, filename))
 		#end if
@@ -85,11 +125,16 @@ def create_cairo_font_face_for_file (filename, faceindex=0, loadoptions=0):
 				cr_face,
 				ct.byref(_ft_destroy_key),
 				ft_face,
-				_freetype_so.FT_Done_Face
+				destroy_func
 			  )
 			if status != CAIRO_STATUS_SUCCESS :
 				raise RuntimeError("Error %d doing user_data dance for %s" % (status, filename))
 			#end if
+			if face_data is not None:
+				with _memory_face_data_lock:
+					_memory_face_data[ft_face.value] = face_data
+				#end with
+			#end if
 			ft_face = None # Cairo has stolen my reference
 		#end if
 
@@ -112,6 +157,97 @@ def create_cairo_font_face_for_file (filename, faceindex=0, loadoptions=0):
 	return face
 #end create_cairo_font_face_for_file
 
+# One registered FreeType backed cairo font face and the scaled fonts made
+# from it so far, keyed by size.
+class RegisteredFace:
+	def __init__(self, face):
+		self.face = face
+		self.refcount = 0
+		self.scaled_fonts = {}
+	#end __init__
+#end RegisteredFace
+
+# Holds one cairo font face (and so one FreeType face) per generation of a
+# font file no matter how many users it has, and one prebuilt
+# cairo.ScaledFont for each size asked for, so neither are made again for
+# every render. A generation is whatever tells versions of the same file
+# apart, like a hash of its contents, so a new version of a font can be
+# loaded while the old one is still in use. Users acquire a face and
+# release it when done, and the face and its scaled fonts are let go once
+# nobody has it acquired. It may be used from more than one thread.
+class FontRegistry:
+	def __init__(self):
+		self.lock = threading.Lock()
+		# Key: (absolute font path, faceindex, generation),
+		# Value: RegisteredFace
+		self.faces = {}
+	#end __init__
+
+	def key(self, filename, faceindex, generation):
+		return (os.path.abspath(filename), faceindex, generation)
+	#end key
+
+	# Return the cairo.FontFace of the generation of the font file, loading
+	# it if nobody has it acquired already. If data is given, it is the
+	# contents of the font file to make the face from.
+	def acquire(self, filename, faceindex=0, generation=None, data=None):
+		key = self.key(filename, faceindex, generation)
+		with self.lock:
+			registered = self.faces.get(key)
+			if registered is None:
+				registered = RegisteredFace(create_cairo_font_face_for_file( \
+					key[0], faceindex, data=data))
+				self.faces[key] = registered
+			#end if
+			registered.refcount += 1
+			return registered.face
+		#end with
+	#end acquire
+
+	def release(self, filename, faceindex=0, generation=None):
+		key = self.key(filename, faceindex, generation)
+		with self.lock:
+			registered = self.faces[key]
+			registered.refcount -= 1
+			if registered.refcount == 0:
+				# cairo calls the face's destroy hook, which is done with the
+				# FreeType face, once the last reference to the face,
+				# including those held by the scaled fonts and by any
+				# contexts still rendering with it, goes away.
+				del self.faces[key]
+			#end if
+		#end with
+	#end release
+
+	# Return the cairo.ScaledFont of an acquired font file at a size in
+	# pixels, with an identity CTM and default font options.
+	def get_scaled_font(self, filename, size, faceindex=0, generation=None):
+		key = self.key(filename, faceindex, generation)
+		with self.lock:
+			registered = self.faces[key]
+			scaled_font = registered.scaled_fonts.get(size)
+			if scaled_font is None:
+				scaled_font = cairo.ScaledFont(registered.face, \
+					cairo.Matrix(xx=size, yy=size), cairo.Matrix(), \
+					cairo.FontOptions())
+				registered.scaled_fonts[size] = scaled_font
+			#end if
+			return scaled_font
+		#end with
+	#end get_scaled_font
+
+	def refcount(self, filename, faceindex=0, generation=None):
+		with self.lock:
+			registered = \
+				self.faces.get(self.key(filename, faceindex, generation))
+			return registered.refcount if registered else 0
+		#end with
+	#end refcount
+#end FontRegistry
+
+# The registry everybody shares.
+registry = FontRegistry()
+
 if __name__ == '__main__':
 	face = create_cairo_font_face_for_file("/usr/share/fonts/truetype/dejavu/DejaVuSerif.ttf", 0)
 	surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 128, 128)
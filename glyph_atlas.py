@@ -0,0 +1,212 @@
+#! /usr/bin/env python3
+
+# Compositing translations out of glyphs cairo rasterized ahead of time.
+#
+# A GlyphAtlas holds every glyph of a font at one size as a little A8 bitmap,
+# rasterized by cairo once at each of a few subpixel x offsets. Drawing a
+# translation is then only a matter of copying the bitmap nearest each glyph
+# position from the layout onto a NumPy canvas of coverage, which is what
+# png_writer encodes, without making a cairo surface or context at all.
+#
+# Glyphs are put together like cairo's OVER operator puts them together
+# on a FORMAT_A8 surface, where each glyph of coverage a turns coverage c
+# into a + c * (1 - a). That is the same as multiplying together how much
+# of each pixel every glyph leaves uncovered, 1 - a, which doesn't depend
+# on the order of the glyphs, so that is what the canvas holds until the
+# end.
+
+import argparse
+import math
+import os
+import numpy as np
+import png_writer as pw
+
+# The subpixel x offsets every glyph is rasterized at, 0, 1/4, 1/2 and 3/4
+# of a pixel. Glyph positions are rounded to the nearest of them.
+SUBPIXELS = 4
+
+# How many levels of coverage, of 255, the atlas may be off from cairo at
+# any pixel, after allowing for the ink to be a pixel away in any
+# direction, since cairo may round glyph positions differently.
+GOLDEN_TOLERANCE = 16
+
+class GlyphAtlas:
+  # ############################
+  # The atlas of the KiltaFont at font_size, holding every glyph the font
+  # maps a character to.
+  def __init__(self, kilta_font, font_size, dpi=72, subpixels=SUBPIXELS):
+    self.font_size = font_size
+    self.dpi = dpi
+    self.subpixels = subpixels
+    self.scaled_font = kilta_font.get_scaled_font(font_size, dpi)
+    # Key: (glyph index, subpixel), Value: (left, top, transmittance) where
+    # transmittance is 1 - the coverage of the bitmap as float32 and (left,
+    # top) is where its top left corner is relative to the pen, or None if
+    # the glyph has no ink.
+    self.bitmaps = {}
+    # How far any bitmap reaches from its pen, so a canvas with this much
+    # room around it never has to clip a glyph.
+    self.margin = 0
+
+    for glyph_index in np.unique(kilta_font.glyph_index_by_cp).tolist():
+      self.add_glyph(glyph_index)
+
+  # ############################
+  # Rasterize the glyph at every subpixel offset.
+  def add_glyph(self, glyph_index):
+    import cairo
+
+    extents = self.scaled_font.glyph_extents([cairo.Glyph(glyph_index, 0, 0)])
+    for subpixel in range(self.subpixels):
+      if extents.width <= 0 or extents.height <= 0:
+        self.bitmaps[(glyph_index, subpixel)] = None
+        continue
+
+      # A pixel more all the way around than the ink, for the antialiasing.
+      x = subpixel / self.subpixels
+      left = math.floor(extents.x_bearing + x) - 1
+      top = math.floor(extents.y_bearing) - 1
+      width = math.ceil(extents.x_bearing + extents.width + x) + 1 - left
+      height = math.ceil(extents.y_bearing + extents.height) + 1 - top
+
+      surface = cairo.ImageSurface(cairo.FORMAT_A8, width, height)
+      ctx = cairo.Context(surface)
+      ctx.set_scaled_font(self.scaled_font)
+      ctx.set_source_rgba(0, 0, 0, 1)
+      ctx.show_glyphs([cairo.Glyph(glyph_index, x - left, -top)])
+      del ctx
+      surface.flush()
+      rows = np.frombuffer(surface.get_data(), dtype=np.uint8, \
+        count=surface.get_stride() * height).reshape(height, -1)[:, :width]
+      transmittance = 1.0 - rows.astype(np.float32) / 255.0
+      surface.finish()
+
+      self.bitmaps[(glyph_index, subpixel)] = (left, top, transmittance)
+      self.margin = max(self.margin, -left, -top, left + width, top + height)
+
+  # ############################
+  # Composite runs of glyphs, each (glyphs, (x, y)) with the glyphs of a
+  # layout and the pen position to move them to, onto a width by height
+  # canvas and return its coverage as a (height, width) array of bytes.
+  def composite(self, runs, width, height):
+    margin = self.margin
+    canvas = np.ones((height + 2 * margin, width + 2 * margin), \
+      dtype=np.float32)
+    bitmaps = self.bitmaps
+    subpixels = self.subpixels
+
+    for glyphs, (x_pen, y_pen) in runs:
+      for glyph in glyphs:
+        # The nearest subpixel position, as the pixel and the subpixel in it.
+        x_pixel, subpixel = divmod(math.floor((glyph.x + x_pen) * subpixels \
+          + 0.5), subpixels)
+        key = (glyph.index, subpixel)
+        if key not in bitmaps:
+          self.add_glyph(glyph.index)
+          if self.margin != margin:
+            # A glyph bigger than any before it; start over with more room.
+            return self.composite(runs, width, height)
+        bitmap = bitmaps[key]
+        if bitmap is None:
+          continue
+        left, top, transmittance = bitmap
+        x0 = x_pixel + left + margin
+        y0 = math.floor(glyph.y + y_pen + 0.5) + top + margin
+        rows, columns = transmittance.shape
+        canvas[y0:y0 + rows, x0:x0 + columns] *= transmittance
+
+    canvas = canvas[margin:margin + height, margin:margin + width]
+    return np.rint(255.0 - canvas * 255.0).astype(np.uint8)
+
+  # ############################
+  def nbytes(self):
+    return sum(bitmap[2].nbytes for bitmap in self.bitmaps.values() \
+      if bitmap is not None)
+
+# ############################
+# How far coverage is from the golden coverage, both (height, width) arrays
+# of bytes: the largest difference at any pixel from the nearest value of
+# the golden coverage within a pixel of it. The images must be the same size.
+def coverage_error(golden, coverage):
+  if golden.shape != coverage.shape:
+    return 255
+  height, width = golden.shape
+  padded = np.pad(golden.astype(np.int16), 1, mode="edge")
+  error = np.full(golden.shape, 255, dtype=np.int16)
+  for dy in (0, 1, 2):
+    for dx in (0, 1, 2):
+      shifted = padded[dy:dy + height, dx:dx + width]
+      np.minimum(error, np.abs(coverage.astype(np.int16) - shifted), \
+        out=error)
+  return int(error.max()) if error.size else 0
+
+# ############################
+# The golden image test: render every one of msgs, which are mastis, with the
+# atlas and with cairo itself and make sure they match within tolerance.
+def do_golden_test(kilta_font, msgs, font_size, tolerance=GOLDEN_TOLERANCE):
+  import mastis_render as mr
+
+  failures = 0
+  worst = 0
+  for msg in msgs:
+    surface = mr.draw_translation(kilta_font, msg, font_size, coverage=True)
+    golden = pw.coverage_rows(surface.get_data(), surface.get_width(), \
+      surface.get_height(), surface.get_stride()).copy()
+    surface.finish()
+    coverage = mr.composite_translation(kilta_font, msg, font_size)
+    error = coverage_error(golden, coverage)
+    worst = max(worst, error)
+    if error > tolerance:
+      failures += 1
+      print(f"ERROR! Atlas is {error} levels off cairo on: {msg!r}")
+  print(f"Golden image test: {len(msgs) - failures}/{len(msgs)} passed, " \
+    f"worst error {worst} levels.")
+  return failures == 0
+
+# ############################
+def main():
+  import textwrap as tw
+  import kilta_bench as kb
+  import kilta_font as kf
+  import kilta_utils as ku
+  import mastis_render as mr
+
+  parser = argparse.ArgumentParser()
+  parser.add_argument("-t", "--test", \
+    help="Run the golden image test against cairo", \
+    action="store_true")
+  parser.add_argument("-f", "--font", \
+    help="Font to test with", \
+    default=os.getenv("MASTIS_FONT", "KiThree.ttf"))
+  parser.add_argument("-s", "--size", \
+    help="Font size to test at", \
+    type=int, \
+    default=mr.FONT_SIZE)
+  parser.add_argument("-n", "--images", \
+    help="How many translations to test", \
+    type=int, \
+    default=64)
+  parser.add_argument("--tolerance", \
+    help="Levels of coverage the atlas may be off from cairo", \
+    type=int, \
+    default=GOLDEN_TOLERANCE)
+  args = parser.parse_args()
+
+  kilta_font = kf.KiltaFont(args.font)
+  atlas = kilta_font.get_glyph_atlas(args.size)
+  print(f"Atlas of {args.font} at {args.size}: {len(atlas.bitmaps)} " \
+    f"bitmaps, {atlas.nbytes()} bytes.")
+
+  if args.test:
+    # Translations of up to 8 wrapped lines, like a .m command makes.
+    kt = ku.KiltaTokenizer(deterministic=True)
+    text = kb.generate_corpus(args.images * 8 * 40)
+    lines = tw.wrap(kt.romanized_to_mastis(text), width=40)
+    msgs = ["\n".join(lines[i:i + 1 + i % 8]) \
+      for i in range(0, len(lines), 8)][:args.images]
+    return 0 if do_golden_test(kilta_font, msgs, args.size, \
+      args.tolerance) else 1
+  return 0
+
+if __name__ == '__main__':
+  os.sys.exit(main())
@@ -0,0 +1,346 @@
+#!/usr/bin/python3
+
+# Benchmarks for the tokenizer and transliteration paths in kilta_utils (and
+# optionally for loading and laying out text with a KiltaFont) over a
+# synthetic Kílta corpus of any size. The results are written out as JSON
+# so they can be kept around and compared between versions.
+
+import argparse
+import collections
+import io
+import json
+import os
+import platform
+import random as rnd
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import kilta_utils as ku
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Read the letters of Kílta from the first paragraph of alphabet.txt.
+def read_alphabet(path=os.path.join(HERE, "alphabet.txt")):
+	letters = []
+	with open(path, encoding="utf-8") as f:
+		for line in f:
+			if not line.strip():
+				break
+			letters.extend(line.split())
+	return letters
+
+# Make up realistic looking Kílta text of at least size characters. Words are
+# built from syllables of an optional onset consonant (or cluster) followed
+# by a vowel (or diphthong) and an occasional coda, with the digraphs and
+# diphthongs weighted so they show up about as often as they do in real
+# text. Sentences have the grammatical markers, punctuation, and line breaks
+# sprinkled in.
+def generate_corpus(size, seed=0, letters=None):
+	if letters is None:
+		letters = read_alphabet()
+	vowels = [l for l in letters if l in "aáeéëiíoóuú"]
+	consonants = [l for l in letters if l not in vowels]
+
+	# Single letters are the most common, digraphs less so, and the three
+	# letter clusters rarer still.
+	onset_weights = [{1: 6, 2: 2, 3: 1}[len(c)] for c in consonants]
+	nuclei = vowels + ["au", "ai", "ui"]
+	nucleus_weights = [4] * len(vowels) + [2, 2, 1]
+	codas = ["n", "r", "l", "s", "t", "m"]
+
+	r = rnd.Random(seed)
+	def word():
+		syllables = []
+		for i in range(r.choice((1, 1, 2, 2, 2, 3, 3, 4))):
+			if r.random() < .8:
+				syllables.append(r.choices(consonants, onset_weights)[0])
+			syllables.append(r.choices(nuclei, nucleus_weights)[0])
+			if r.random() < .2:
+				syllables.append(r.choice(codas))
+		return "".join(syllables)
+
+	out = []
+	total = 0
+	while total < size:
+		words = [word() for i in range(r.randint(3, 12))]
+		for i in range(1, len(words) - 1):
+			if r.random() < .1:
+				words[i] = r.choice(("në", "vë"))
+		words[0] = words[0].capitalize()
+		sentence = " ".join(words) + r.choice((".", ".", ".", ",", "!", "?"))
+		sentence += "\n" if r.random() < .3 else " "
+		out.append(sentence)
+		total += len(sentence)
+	return "".join(out)
+
+# Run fn over the text repeat times and return the best wall clock seconds.
+def best_time(fn, text, repeat):
+	best = None
+	for i in range(repeat):
+		start = time.perf_counter()
+		fn(text)
+		elapsed = time.perf_counter() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best
+
+# The peak bytes of Python memory allocated while running fn over the text.
+def peak_memory(fn, text):
+	tracemalloc.start()
+	try:
+		fn(text)
+		return tracemalloc.get_traced_memory()[1]
+	finally:
+		tracemalloc.stop()
+
+def bench_tokenize(kt, text):
+	# Consume the lazy tokens without keeping them.
+	collections.deque(kt.tokenize(text), maxlen=0)
+
+def bench_tokenize_all(kt, text):
+	kt.tokenize_all(text)
+
+def bench_tokenize_stream(kt, text):
+	collections.deque(kt.tokenize_stream(io.StringIO(text)), maxlen=0)
+
+def bench_romanized_to_mastis(kt, text):
+	kt.romanized_to_mastis(text)
+
+def bench_romanized_to_mastis_lines(kt, text):
+	collections.deque(kt.romanized_to_mastis_many(text.splitlines()), \
+		maxlen=0)
+
+PATHS = {
+	"tokenize": bench_tokenize,
+	"tokenize_all": bench_tokenize_all,
+	"tokenize_stream": bench_tokenize_stream,
+	"romanized_to_mastis": bench_romanized_to_mastis,
+	"romanized_to_mastis_lines": bench_romanized_to_mastis_lines,
+}
+
+def result(seconds, chars, tokens, peak_bytes):
+	return {
+		"seconds": seconds,
+		"chars_per_second": chars / seconds if seconds else None,
+		"tokens_per_second": tokens / seconds if seconds else None,
+		"peak_memory_bytes": peak_bytes,
+	}
+
+# Time the kilta_utils command line translator over the text in a file. Its
+# peak memory is the child's maximum resident set size, which is only
+# meaningful if this is the largest child we've run.
+def bench_cli(text, tokens, repeat, jobs):
+	with tempfile.NamedTemporaryFile("w", encoding="utf-8", \
+			suffix=".txt", delete=False) as f:
+		f.write(text)
+	try:
+		cmd = [sys.executable, os.path.join(HERE, "kilta_utils.py"), \
+			"--jobs", str(jobs), f.name]
+		best = None
+		for i in range(repeat):
+			start = time.perf_counter()
+			subprocess.run(cmd, stdout=subprocess.DEVNULL, check=True)
+			elapsed = time.perf_counter() - start
+			best = elapsed if best is None else min(best, elapsed)
+	finally:
+		os.unlink(f.name)
+
+	# ru_maxrss is in kilobytes on Linux, bytes on macOS.
+	maxrss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+	if sys.platform != "darwin":
+		maxrss *= 1024
+	return result(best, len(text), tokens, maxrss)
+
+# Time loading the font with and without its metrics cache, building its
+# kerning matrix on its own, laying out the text as wrapped lines of mastis
+# like the bot does, both through the font's layout cache and without it,
+# encoding images of them, and rendering them from start to finish.
+def bench_font(font_path, text, repeat, png_compression=6):
+	import cairo
+	import textwrap as tw
+	import kilta_font as kf
+
+	# The first load compiles the metrics cache if it isn't there already.
+	font = kf.KiltaFont(font_path)
+	best_load = best_time(kf.KiltaFont, font_path, repeat)
+	best_cold_load = best_time(lambda path: \
+		kf.KiltaFont(path, use_metrics_cache=False), font_path, repeat)
+	best_kerning = best_time(lambda f: f.build_kerning_matrix(), font, repeat)
+
+	kt = ku.KiltaTokenizer(deterministic=True)
+	lines = tw.wrap(kt.romanized_to_mastis(text), width=40)
+	chars = sum(len(line) for line in lines)
+	surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 1, 1)
+	ctx = cairo.Context(surface)
+	def layout(lines):
+		for line in lines:
+			ctx.move_to(0, 0)
+			font.layout_line(ctx, line, 30)
+	def compute_layout(lines):
+		for line in lines:
+			font.compute_layout(line, 30)
+	seconds = best_time(layout, lines, repeat)
+	uncached_seconds = best_time(compute_layout, lines, repeat)
+
+	return {
+		"font": font_path,
+		"kerning_source": font.kerning_source,
+		"glyphs": len(font.kern_matrix),
+		"startup_seconds": best_load,
+		"uncached_startup_seconds": best_cold_load,
+		"kerning_matrix_seconds": best_kerning,
+		"layout": {
+			"lines": len(lines),
+			"seconds": seconds,
+			"lines_per_second": len(lines) / seconds if seconds else None,
+			"chars_per_second": chars / seconds if seconds else None,
+			"peak_memory_bytes": peak_memory(layout, lines),
+			"uncached_seconds": uncached_seconds,
+			"cache": font.layout_cache.stats(),
+		},
+		"png": bench_png(font, lines, repeat, png_compression),
+		"render": bench_render(font, lines, repeat, png_compression),
+	}
+
+# Time encoding translation images like the bot's as the full RGBA PNG
+# cairo writes and in each of the png_writer modes, and how big they come
+# out. The images are made of up to 8 wrapped lines each, about what a .m
+# command makes, and drawn once up front so only the encoding is timed.
+def bench_png(font, lines, repeat, level, images=64):
+	import mastis_render as mr
+	import png_writer as pw
+
+	msgs = ["\n".join(lines[i:i + 8]) for i in range(0, len(lines), 8)]
+	msgs = msgs[:images]
+	results = {}
+	for mode in ("rgba",) + pw.PNG_MODES:
+		surfaces = [mr.draw_translation(font, msg, coverage=mode != "rgba") \
+			for msg in msgs]
+		def encode(surfaces):
+			return [mr.encode_translation(surface, png_mode=mode, \
+				png_compression=level) for surface in surfaces]
+		seconds = best_time(encode, surfaces, repeat)
+		sizes = [len(png) for png in encode(surfaces)]
+		for surface in surfaces:
+			surface.finish()
+		results[mode] = {
+			"images": len(msgs),
+			"seconds_per_image": seconds / len(msgs) if msgs else None,
+			"bytes_per_image": sum(sizes) / len(sizes) if sizes else None,
+		}
+	return results
+
+# Time rendering translation images like the bot's from mastis to palette
+# PNG bytes, drawn by cairo and composited out of the glyph atlas. The
+# atlas is made before timing, like the bot's render workers do.
+def bench_render(font, lines, repeat, level, images=64):
+	import mastis_render as mr
+
+	msgs = ["\n".join(lines[i:i + 8]) for i in range(0, len(lines), 8)]
+	msgs = msgs[:images]
+	start = time.perf_counter()
+	font.get_glyph_atlas(mr.FONT_SIZE)
+	atlas_seconds = time.perf_counter() - start
+
+	results = {"atlas_build_seconds": atlas_seconds}
+	for renderer in ("cairo", "atlas"):
+		def render(msgs):
+			for msg in msgs:
+				mr.render_translation(font, msg, png_mode="palette", \
+					png_compression=level, renderer=renderer)
+		seconds = best_time(render, msgs, repeat)
+		results[renderer] = {
+			"images": len(msgs),
+			"seconds_per_image": seconds / len(msgs) if msgs else None,
+			"images_per_second": len(msgs) / seconds if seconds else None,
+		}
+	cairo_seconds = results["cairo"]["seconds_per_image"]
+	atlas_seconds = results["atlas"]["seconds_per_image"]
+	results["speedup"] = cairo_seconds / atlas_seconds \
+		if cairo_seconds and atlas_seconds else None
+	return results
+
+def run(size, seed, repeat, paths, jobs, font_path=None, png_compression=6):
+	text = generate_corpus(size, seed)
+	kt = ku.KiltaTokenizer()
+	tokens = len(kt.tokenize_all(text))
+
+	results = {}
+	for name in paths:
+		if name == "cli":
+			results[name] = bench_cli(text, tokens, repeat, jobs)
+			continue
+		fn = PATHS[name]
+		seconds = best_time(lambda t: fn(kt, t), text, repeat)
+		peak = peak_memory(lambda t: fn(kt, t), text)
+		results[name] = result(seconds, len(text), tokens, peak)
+
+	if font_path:
+		results["font"] = bench_font(font_path, text, repeat, png_compression)
+
+	return {
+		"benchmark": "kilta_utils",
+		"timestamp": time.time(),
+		"python": platform.python_version(),
+		"platform": platform.platform(),
+		"corpus": {"chars": len(text), "tokens": tokens, "seed": seed},
+		"repeat": repeat,
+		"results": results,
+	}
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-s", "--size", \
+		help="Characters of synthetic Kílta to generate", \
+		type=int, \
+		default=1000000)
+	parser.add_argument("--seed", \
+		help="Seed for the corpus generator", \
+		type=int, \
+		default=0)
+	parser.add_argument("-r", "--repeat", \
+		help="Take the best time of this many runs", \
+		type=int, \
+		default=3)
+	parser.add_argument("-p", "--path", \
+		help="Path to benchmark, may be given more than once", \
+		choices=list(PATHS) + ["cli"], \
+		action="append")
+	parser.add_argument("-j", "--jobs", \
+		help="Processes for the cli path", \
+		type=int, \
+		default=1)
+	parser.add_argument("-f", "--font", \
+		help="Also benchmark loading and laying out lines with this font")
+	parser.add_argument("--png-compression", \
+		help="zlib level for the png_writer modes of the font benchmark", \
+		type=int, \
+		default=6)
+	parser.add_argument("-o", "--output", \
+		help="Write the JSON results here instead of stdout")
+	parser.add_argument("--corpus", \
+		help="Just write the synthetic corpus to stdout", \
+		action="store_true")
+	args = parser.parse_args()
+
+	if args.corpus:
+		sys.stdout.write(generate_corpus(args.size, args.seed))
+		return 0
+
+	paths = args.path or list(PATHS) + ["cli"]
+	report = run(args.size, args.seed, max(args.repeat, 1), paths, args.jobs, \
+		args.font, args.png_compression)
+	if args.output:
+		with open(args.output, "w") as f:
+			json.dump(report, f, indent=2)
+			f.write("\n")
+	else:
+		json.dump(report, sys.stdout, indent=2)
+		print()
+	return 0
+
+if __name__ == '__main__':
+	os.sys.exit(main())
@@ -1,151 +1,637 @@
 # Code to perform Pango-like font cairo interactions and font 
 # layout with the Kílta Font.
 
+import argparse
+import collections
+import hashlib
+import io
+import json
+import mmap
 import os
+import struct
+import sys
 import font_helper as fh
 import kilta_utils as ku
-from fontTools import ttLib
 import math
+import numpy as np
 
 # debugging
 import python_object_stuff as pos
 import cairo
 
+# A laid out line of mastis. The glyphs are a tuple of cairo.Glyph and the
+# extents a cairo.TextExtents of the ink and advance of the line relative to
+# where it was laid out.
+LineLayout = collections.namedtuple('LineLayout', ['glyphs', 'extents'])
+
+# Larger than any coordinate in font units, for glyphs without ink.
+NO_INK = 1 << 40
+
+# The largest codepoint there is in mastis, which is all the glyph metrics
+# tables are indexed by. Anything past it gets the fallback glyph, so a font
+# which also maps far away codepoints (like the private use area) doesn't
+# make the tables any larger.
+MASTIS_MAX_CODEPOINT = max(ord(c) \
+	for encoding in ku.KiltaTokenizer.mastis_encoding.values() \
+	for c in encoding)
+
+# How many laid out lines a KiltaFont remembers, and how much memory they
+# may use at most.
+LAYOUT_CACHE_ENTRIES = 4096
+LAYOUT_CACHE_BYTES = 8 * 1024 * 1024
+
+# About how much memory a line layout in the layout cache keyed by
+# (mastis, font_size, dpi) uses. Each cairo.Glyph is a tuple of an int and
+# two floats.
+def layout_nbytes(key, line_layout):
+	glyphs = line_layout.glyphs
+	glyph_nbytes = 0
+	if glyphs:
+		glyph_nbytes = sys.getsizeof(glyphs[0]) + sys.getsizeof(0) + \
+			2 * sys.getsizeof(0.0)
+	return sys.getsizeof(key) + sys.getsizeof(key[0]) + \
+		sys.getsizeof(glyphs) + len(glyphs) * glyph_nbytes + \
+		sys.getsizeof(line_layout.extents)
+
+# The compiled font metrics are cached in a file next to the font with this
+# suffix. It starts with the magic, then the length of a JSON header, then
+# the header, which holds the scalar metrics and where each array is, then
+# the arrays themselves, each aligned so they can be used memory mapped.
+METRICS_CACHE_SUFFIX = '.kmetrics'
+METRICS_CACHE_MAGIC = b'KMETRIC2'
+METRICS_CACHE_ALIGN = 64
+
+# What KiltaFont keeps in the metrics cache. A cache missing any of these is
+# compiled again.
+METRICS_CACHE_SCALARS = ('units_per_em', 'ascent', 'descent', 'line_gap', \
+	'max_advance', 'fallback_codepoint', 'kerning_source')
+METRICS_CACHE_ARRAYS = ('glyph_index_by_cp', 'advance_by_cp', 'lsb_by_cp', \
+	'compact_id_by_cp', 'kern_matrix', 'x_min_by_cid', 'y_min_by_cid', \
+	'x_max_by_cid', 'y_max_by_cid')
+
+# The attributes of a KiltaFont which come straight from the font tables.
+FONT_TABLE_ATTRS = ('tt', 'cmap', 'kern_table', 'gmap', 'hmtx', \
+	'fallback_glyph_name')
+
+def metrics_cache_align(offset):
+	return -(-offset // METRICS_CACHE_ALIGN) * METRICS_CACHE_ALIGN
+
+# Write the scalars (a dict of JSON values) and the arrays (a dict of NumPy
+# arrays) to a metrics cache file. It is written to a temporary file first
+# and renamed over the old one, so nobody ever maps half a cache.
+def write_metrics_cache(path, scalars, arrays):
+	layout = {}
+	offset = 0
+	for name, array in arrays.items():
+		layout[name] = [array.dtype.str, list(array.shape), offset]
+		offset = metrics_cache_align(offset + array.nbytes)
+	header = json.dumps({'scalars': scalars, 'arrays': layout}).encode()
+	start = metrics_cache_align(len(METRICS_CACHE_MAGIC) + 8 + len(header))
+
+	tmp_path = f"{path}.{os.getpid()}.tmp"
+	try:
+		with open(tmp_path, 'wb') as f:
+			f.write(METRICS_CACHE_MAGIC)
+			f.write(struct.pack('<Q', len(header)))
+			f.write(header)
+			for name, array in arrays.items():
+				f.seek(start + layout[name][2])
+				f.write(np.ascontiguousarray(array).tobytes())
+		os.replace(tmp_path, path)
+	finally:
+		if os.path.exists(tmp_path):
+			os.unlink(tmp_path)
+
+# Memory map a metrics cache file and return its (scalars, arrays), where
+# the arrays are read only views of the mapping, or None if the file isn't
+# a metrics cache. Raises ValueError if the file is a metrics cache, but a
+# broken one.
+def read_metrics_cache(path):
+	with open(path, 'rb') as f:
+		mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+	magic_len = len(METRICS_CACHE_MAGIC)
+	if len(mapping) < magic_len + 8 or \
+			mapping[:magic_len] != METRICS_CACHE_MAGIC:
+		return None
+	(header_len,) = struct.unpack_from('<Q', mapping, magic_len)
+	header = json.loads(mapping[magic_len + 8:magic_len + 8 + header_len])
+	start = metrics_cache_align(magic_len + 8 + header_len)
+
+	# The header may be cut short or edited by hand into anything at all.
+	try:
+		scalars = header['scalars']
+		arrays = {}
+		for name, (dtype, shape, offset) in header['arrays'].items():
+			dtype = np.dtype(dtype)
+			count = math.prod(shape)
+			if start + offset + count * dtype.itemsize > len(mapping):
+				return None
+			arrays[name] = np.frombuffer(mapping, dtype, count, \
+				start + offset).reshape(shape)
+	except (KeyError, TypeError, AttributeError) as e:
+		raise ValueError(f"Bad metrics cache header: {e!r}") from e
+	if not isinstance(scalars, dict):
+		raise ValueError("Bad metrics cache header: scalars aren't a dict")
+	return scalars, arrays
+
+# The x advance adjustment in a GPOS value record, which may be missing.
+def x_advance(value_record):
+	if value_record is None:
+		return 0
+	return getattr(value_record, 'XAdvance', 0) or 0
+
 class KiltaFont():
-	def __init__(self, font_path):
+	def __init__(self, font_path, layout_cache_entries=LAYOUT_CACHE_ENTRIES, \
+			layout_cache_bytes=LAYOUT_CACHE_BYTES, use_metrics_cache=True):
 		self.font_path = os.path.abspath(font_path)
 
+		# Lines laid out at the origin keyed by (mastis, font_size, dpi).
+		self.layout_cache = ku.LRUCache(layout_cache_entries, \
+			layout_cache_bytes, layout_nbytes)
+
+		# Glyph atlases for compositing renders keyed by (font_size, dpi),
+		# made only the first time anybody asks for that size.
+		self.glyph_atlases = {}
+
+		# Everything is made from this one snapshot of the font file, so the
+		# file may be replaced with a new version at any time. Its hash tells
+		# versions of the font apart.
+		with open(self.font_path, 'rb') as f:
+			self.font_data = f.read()
+		self.font_hash = hashlib.sha256(self.font_data).hexdigest()
+
 		# Load and create a Cairo Font Face object that suitable for 
-		# cairo's font processing.
-		self.cairo_font_face = \
-			fh.create_cairo_font_face_for_file(self.font_path, 0)
+		# cairo's font processing. It is shared through the font registry
+		# with anybody else using the same version of the font, until
+		# release() is called.
+		self.cairo_font_face = fh.registry.acquire(self.font_path, \
+			generation=self.font_hash, data=self.font_data)
+
+		# If the metrics can't be made, like for a file FreeType takes but
+		# fontTools doesn't, nobody will ever release the face, so do it here.
+		try:
+			self.load_metrics(use_metrics_cache)
+		except BaseException:
+			self.release()
+			raise
+
+	# Load the metrics layout needs from the metrics cache, or compile them.
+	def load_metrics(self, use_metrics_cache):
+		# Everything layout needs is compiled from the font tables by
+		# fontTools, which is slow, so it is kept in a cache file next to
+		# the font and only compiled again when the font changes.
+		self.metrics_cache_path = self.font_path + METRICS_CACHE_SUFFIX
+		self.metrics_cache_loaded = use_metrics_cache and \
+			self.load_metrics_cache()
+		if self.metrics_cache_loaded:
+			return
+
+		self.load_font_tables()
+
+		# Store units per Em (ensure to use a float!)
+		self.units_per_em = float(self.tt['head'].unitsPerEm)
+
+		# Vertical metrics in font units, y up, so descent is negative.
+		self.ascent = self.tt['hhea'].ascent
+		self.descent = self.tt['hhea'].descent
+		self.line_gap = self.tt['hhea'].lineGap
+		self.max_advance = self.tt['hhea'].advanceWidthMax
+
+		self.build_glyph_metrics_table()
+		self.build_kerning_matrix()
+
+		if use_metrics_cache:
+			self.save_metrics_cache()
+
+	# The font tables themselves are only loaded when something asks for
+	# them, which is never for layout when the metrics cache is good.
+	def __getattr__(self, name):
+		if name in FONT_TABLE_ATTRS:
+			self.load_font_tables()
+			return self.__dict__[name]
+		raise AttributeError(name)
+
+	def load_font_tables(self):
+		# NOTE: Importing fontTools alone takes a noticeable part of startup.
+		from fontTools import ttLib
 
 		# Create a _different_ font object with a different API 
 		# suitable for kerning processing. It sucks we need to use two 
 		# different APIs
-		self.tt = ttLib.TTFont(self.font_path)
-		
-		# Store units per Em (ensure to use a float!)
-		self.units_per_em = float(self.tt['head'].unitsPerEm)
+		self.tt = ttLib.TTFont(io.BytesIO(self.font_data))
 
 		# map from character ordinal to glyph name
 		self.cmap = self.tt.getBestCmap()
 
 		# map from tuple left/right glyph names to x kerning offset.
-		self.kern_table = self.tt['kern'].getkern(0).kernTable
+		self.kern_table = {}
+		if 'kern' in self.tt:
+			self.kern_table = self.tt['kern'].getkern(0).kernTable
 
 		# map from glyph_name to glyph_index in font
 		self.gmap = self.tt.getReverseGlyphMap()
 
-		# knowledge about each glyph's widths, key is glyph name, value
-		# is an object which has a 'width' attribute in ems for the glpyh
-		self.glyph_set = dict(self.tt.getGlyphSet())
+		# map from glyph_name to (advance width, lsb) in font units
+		self.hmtx = self.tt['hmtx']
+
+		# What any character the font doesn't have turns into.
+		self.fallback_glyph_name = '.notdef' \
+			if '.notdef' in self.gmap else self.tt.getGlyphOrder()[0]
+
+	# Write the compiled metrics to the metrics cache file. It is only a
+	# cache, so failing to write it just means compiling them next time too.
+	def save_metrics_cache(self):
+		scalars = {name: getattr(self, name) for name in METRICS_CACHE_SCALARS}
+		scalars['font_hash'] = self.font_hash
+		arrays = {name: getattr(self, name) for name in METRICS_CACHE_ARRAYS}
+		try:
+			write_metrics_cache(self.metrics_cache_path, scalars, arrays)
+		except OSError as e:
+			print(f"Warning: Could not write font metrics cache " \
+				f"{self.metrics_cache_path}: {e}")
+
+	# Use the compiled metrics in the metrics cache file, memory mapped, if
+	# it is there and was compiled from this very font. Return whether it was.
+	def load_metrics_cache(self):
+		try:
+			cached = read_metrics_cache(self.metrics_cache_path)
+		except (OSError, ValueError):
+			return False
+		if cached is None:
+			return False
+
+		scalars, arrays = cached
+		if scalars.get('font_hash') != self.font_hash or \
+				any(name not in scalars for name in METRICS_CACHE_SCALARS) or \
+				any(name not in arrays for name in METRICS_CACHE_ARRAYS):
+			return False
+
+		# And the tables must fit together, or layout would index past them.
+		size = scalars['fallback_codepoint']
+		glyphs = len(arrays['x_min_by_cid'])
+		if not isinstance(size, int) or \
+				any(arrays[name].shape != (size + 1,) for name in \
+					('glyph_index_by_cp', 'advance_by_cp', 'lsb_by_cp', \
+					'compact_id_by_cp')) or \
+				arrays['kern_matrix'].shape != (glyphs, glyphs) or \
+				any(arrays[name].shape != (glyphs,) for name in \
+					('y_min_by_cid', 'x_max_by_cid', 'y_max_by_cid')):
+			return False
+
+		for name in METRICS_CACHE_SCALARS:
+			setattr(self, name, scalars[name])
+		for name in METRICS_CACHE_ARRAYS:
+			setattr(self, name, arrays[name])
+		return True
+
+	# Precompute NumPy arrays indexed by codepoint of the glyph index, advance
+	# width, and lsb, the widths in font units, for every codepoint up to the
+	# largest one the font maps, but no further than MASTIS_MAX_CODEPOINT.
+	# Anything unmapped gets the fallback glyph. There is one extra entry at
+	# the end for the fallback glyph, so clamping a codepoint to
+	# fallback_codepoint makes anything past the end of the tables use it too.
+	def build_glyph_metrics_table(self):
+		size = min(max(self.cmap, default=0), MASTIS_MAX_CODEPOINT) + 2
+		self.fallback_codepoint = size - 1
+
+		name = self.fallback_glyph_name
+		advance, lsb = self.hmtx[name]
+		self.glyph_index_by_cp = np.full(size, self.gmap[name], dtype=np.int32)
+		self.advance_by_cp = np.full(size, advance, dtype=np.int32)
+		self.lsb_by_cp = np.full(size, lsb, dtype=np.int32)
+
+		for codepoint, name in self.cmap.items():
+			if codepoint >= self.fallback_codepoint:
+				continue
+			advance, lsb = self.hmtx[name]
+			self.glyph_index_by_cp[codepoint] = self.gmap[name]
+			self.advance_by_cp[codepoint] = advance
+			self.lsb_by_cp[codepoint] = lsb
+
+	# Number the glyphs the glyph metrics tables can reach (and the fallback
+	# glyph, which is always 0) compactly, and precompute a dense N x N int16
+	# matrix of the kerning in font units between every left and right glyph
+	# indexed by those compact glyph ids. Also precompute the compact glyph
+	# id of every codepoint like the other glyph metrics tables.
+	#
+	# The kerning comes from the pair adjustments in GPOS if the font has
+	# any, since that is where our fonts really keep it (and what a shaper
+	# would use), and from the legacy kern table otherwise.
+	def build_kerning_matrix(self):
+		names = [self.fallback_glyph_name]
+		names += sorted(set(name for codepoint, name in self.cmap.items() \
+			if codepoint < self.fallback_codepoint) - set(names), \
+			key=lambda name: self.gmap[name])
+		compact_ids = {name: cid for cid, name in enumerate(names)}
+
+		self.compact_id_by_cp = np.zeros(len(self.glyph_index_by_cp), \
+			dtype=np.int32)
+		for codepoint, name in self.cmap.items():
+			if codepoint < self.fallback_codepoint:
+				self.compact_id_by_cp[codepoint] = compact_ids[name]
+
+		self.compact_glyph_names = names
+		self.build_glyph_bounds()
+
+		self.kern_matrix = self.build_gpos_kerning_matrix(names, compact_ids)
+		self.kerning_source = 'GPOS'
+		if self.kern_matrix is not None:
+			return
+
+		self.kerning_source = 'kern'
+		self.kern_matrix = np.zeros((len(names), len(names)), dtype=np.int16)
+		for (left, right), kern_val in self.kern_table.items():
+			if left in compact_ids and right in compact_ids:
+				self.kern_matrix[compact_ids[left], compact_ids[right]] = \
+					kern_val
+
+	# Precompute the bounding box of the outline of each glyph in font units
+	# (y up) indexed by compact glyph id. A glyph with no outline at all gets
+	# an inside out box so it never affects the union of boxes.
+	def build_glyph_bounds(self):
+		count = len(self.compact_glyph_names)
+		self.x_min_by_cid = np.full(count, NO_INK, dtype=np.int64)
+		self.y_min_by_cid = np.full(count, NO_INK, dtype=np.int64)
+		self.x_max_by_cid = np.full(count, -NO_INK, dtype=np.int64)
+		self.y_max_by_cid = np.full(count, -NO_INK, dtype=np.int64)
+		for cid, name in enumerate(self.compact_glyph_names):
+			bounds = self.get_glyph_bounds(name)
+			if bounds is not None:
+				self.x_min_by_cid[cid], self.y_min_by_cid[cid], \
+					self.x_max_by_cid[cid], self.y_max_by_cid[cid] = bounds
+
+	# The (x_min, y_min, x_max, y_max) of a glyph's outline in font units, or
+	# None if it doesn't have one.
+	def get_glyph_bounds(self, glyph_name):
+		if 'glyf' in self.tt:
+			glyph = self.tt['glyf'][glyph_name]
+			if glyph.numberOfContours == 0:
+				return None
+			return (glyph.xMin, glyph.yMin, glyph.xMax, glyph.yMax)
+
+		# CFF outlines have to be drawn to find out.
+		from fontTools.pens.boundsPen import BoundsPen
+		glyph_set = self.tt.getGlyphSet()
+		pen = BoundsPen(glyph_set)
+		glyph_set[glyph_name].draw(pen)
+		return pen.bounds
+
+	# Flatten the x advance adjustments of the GPOS pair positioning lookups
+	# used by the kern feature (or of all of them if there's no kern feature)
+	# into a kerning matrix indexed by the compact glyph ids. Both format 1
+	# (lists of glyph pairs) and format 2 (pairs of glyph classes, which are
+	# expanded here since there are so few glyphs) subtables are handled.
+	# Returns None if the font has no pair adjustments at all.
+	def build_gpos_kerning_matrix(self, names, compact_ids):
+		if 'GPOS' not in self.tt:
+			return None
+		gpos = self.tt['GPOS'].table
+		if gpos.LookupList is None:
+			return None
+
+		lookups = gpos.LookupList.Lookup
+		lookup_indexes = set()
+		if gpos.FeatureList is not None:
+			for record in gpos.FeatureList.FeatureRecord:
+				if record.FeatureTag == 'kern':
+					lookup_indexes.update(record.Feature.LookupListIndex)
+		if not lookup_indexes:
+			lookup_indexes = range(len(lookups))
+
+		count = len(names)
+		matrix = np.zeros((count, count), dtype=np.int16)
+		found = False
+		for lookup_index in sorted(lookup_indexes):
+			lookup = lookups[lookup_index]
+			# Within a lookup the first subtable that applies to a pair wins,
+			# but every lookup gets applied in turn.
+			applied = np.zeros((count, count), dtype=bool)
+			for subtable in lookup.SubTable:
+				lookup_type = lookup.LookupType
+				if lookup_type == 9:
+					lookup_type = subtable.ExtensionLookupType
+					subtable = subtable.ExtSubTable
+				if lookup_type != 2:
+					continue
+
+				found = True
+				if subtable.Format == 1:
+					self.apply_pair_pos_format_1(subtable, compact_ids, \
+						matrix, applied)
+				elif subtable.Format == 2:
+					self.apply_pair_pos_format_2(subtable, names, \
+						compact_ids, matrix, applied)
+
+		return matrix if found else None
+
+	def apply_pair_pos_format_1(self, subtable, compact_ids, matrix, applied):
+		for left, pair_set in zip(subtable.Coverage.glyphs, subtable.PairSet):
+			left_id = compact_ids.get(left)
+			if left_id is None:
+				continue
+			for record in pair_set.PairValueRecord:
+				right_id = compact_ids.get(record.SecondGlyph)
+				if right_id is None or applied[left_id, right_id]:
+					continue
+				applied[left_id, right_id] = True
+				matrix[left_id, right_id] += x_advance(record.Value1)
+
+	def apply_pair_pos_format_2(self, subtable, names, compact_ids, matrix, \
+			applied):
+		# The class of each right glyph, where unlisted glyphs are class 0.
+		class_defs_2 = subtable.ClassDef2.classDefs \
+			if subtable.ClassDef2 is not None else {}
+		right_classes = np.array([class_defs_2.get(name, 0) \
+			for name in names], dtype=np.int32)
+
+		# The x advance adjustment for each class 1, class 2 pair.
+		class_kerning = np.array([[x_advance(record.Value1) \
+			for record in class_1_record.Class2Record] \
+			for class_1_record in subtable.Class1Record], dtype=np.int16)
+
+		class_defs_1 = subtable.ClassDef1.classDefs \
+			if subtable.ClassDef1 is not None else {}
+		for left in subtable.Coverage.glyphs:
+			left_id = compact_ids.get(left)
+			if left_id is None:
+				continue
+			# The subtable applies to every right glyph for a covered left one.
+			row = class_kerning[class_defs_1.get(left, 0)][right_classes]
+			todo = ~applied[left_id]
+			matrix[left_id, todo] += row[todo]
+			applied[left_id] = True
+
+	# Convert a string of mastis to an array of codepoints we can index the
+	# glyph metrics tables with.
+	def mastis_to_codepoints(self, mastis):
+		codepoints = np.frombuffer(mastis.encode('utf-32-le'), dtype=np.uint32)
+		return np.minimum(codepoints, self.fallback_codepoint)
+
+	# Return the (glyph index, advance width, lsb) of a mastis character.
+	def get_glyph_metrics(self, mchar):
+		mord = min(ord(mchar), self.fallback_codepoint)
+		return (int(self.glyph_index_by_cp[mord]), \
+			int(self.advance_by_cp[mord]), int(self.lsb_by_cp[mord]))
 
 	def get_cairo_font_face(self):
 		return self.cairo_font_face
+
+	# The shared cairo.ScaledFont of the font at a size, made only the first
+	# time anybody asks for that size.
+	def get_scaled_font(self, font_size, dpi=72):
+		return fh.registry.get_scaled_font(self.font_path, \
+			font_size * dpi / 72.0, generation=self.font_hash)
+
+	# The glyph_atlas.GlyphAtlas of the font at a size.
+	def get_glyph_atlas(self, font_size, dpi=72):
+		key = (font_size, dpi)
+		atlas = self.glyph_atlases.get(key)
+		if atlas is None:
+			import glyph_atlas as ga
+			atlas = ga.GlyphAtlas(self, font_size, dpi)
+			self.glyph_atlases[key] = atlas
+		return atlas
+
+	# Let go of the cairo font face in the font registry. The KiltaFont can't
+	# render afterwards, though whoever is still rendering with its face or
+	# scaled fonts can finish, and so can anybody holding the face with
+	# acquire_face().
+	def release(self):
+		if self.cairo_font_face is not None:
+			self.cairo_font_face = None
+			fh.registry.release(self.font_path, generation=self.font_hash)
+
+	# Hold onto the font's face in the font registry until the matching
+	# release_face(), so the KiltaFont can still render in the meantime even
+	# if somebody calls release().
+	def acquire_face(self):
+		fh.registry.acquire(self.font_path, generation=self.font_hash, \
+			data=self.font_data)
+
+	def release_face(self):
+		fh.registry.release(self.font_path, generation=self.font_hash)
 	
 	# NOTE: This function expects the mastis encoding.
 	def get_kerning_for_pair(self, left_char, right_char):
-		left_ord = ord(left_char)
-		left_glyph_name = self.cmap.get(left_ord)
-		if left_glyph_name is None:
-			return 0
-
-		right_ord = ord(right_char)
-		right_glyph_name = self.cmap.get(right_ord)
-		if right_glyph_name is None:
-			return 0
-
-		kern_val = self.kern_table.get((left_glyph_name, right_glyph_name))
-		if kern_val is None:
-			return 0
-
-		return kern_val
+		left_ord = min(ord(left_char), self.fallback_codepoint)
+		right_ord = min(ord(right_char), self.fallback_codepoint)
+		return int(self.kern_matrix[self.compact_id_by_cp[left_ord], \
+			self.compact_id_by_cp[right_ord]])
 	
 	# Convert a mastis character to a glyph name 
 	def get_glyph_name(self, mchar):
 		mord = ord(mchar)
-		mglyph_name = self.cmap.get(mord)
+		mglyph_name = self.cmap.get(mord, self.fallback_glyph_name)
 		return mglyph_name
 
 	# Convert a mastis character to a glyph index (suitable for cairo)
 	def get_glyph_index(self, mchar):
-		mord = ord(mchar)
-		mglyph_name = self.cmap.get(mord)
-		return self.gmap.get(mglyph_name)
+		return self.get_glyph_metrics(mchar)[0]
 	
 	# TODO: It is so hard to get correct glyph extent data from ttLib. WTF.
 	def get_glyph_width(self, glyph_name):
-		g = self.glyph_set.get(glyph_name)
-		return g.width
+		if glyph_name not in self.gmap:
+			glyph_name = self.fallback_glyph_name
+		return self.hmtx[glyph_name][0]
 
 	def get_glyph_lsb(self, glyph_name):
-		g = self.glyph_set.get(glyph_name)
-		return g.lsb
+		if glyph_name not in self.gmap:
+			glyph_name = self.fallback_glyph_name
+		return self.hmtx[glyph_name][1]
 		
 	# Given a single line of mastis characters, lay it out in accordance with
 	# kerning rules against an origin of (0,0) using the size of the characters
 	# in the font itself. We work from the raw ems units themselves and compute
 	# what we need from first principles. According to manuals, the default dpi
 	# of cairo's text rendering _appears_ to be 72dpi by inspection.
-	def layout_line(self, ctx, mastis, font_size, dpi=72):
-		# First, cut the mastis line into kerning pairs in the order of the
-		# utterance.
-		kpairs = []
-		for i in range(len(mastis)):
-			if (i+1 < len(mastis)):
-				kpairs.append((mastis[i], mastis[i+1]))
-			else:
-				kpairs.append((mastis[i], None))
-		#print(f"kpairs = {kpairs}")
-
-		# Walk down the pairs converting to a list of:
-		# [glyph_id, x_px, y_px] lists that indicate where to place 
-		# the glyph relative to the location of the current pen.
-		glayout = []
-		dx_ems = 0
-		dy_ems = 0
+	#
+	# This returns a LineLayout whose extents are computed from the font's
+	# metrics alone, so no surface or context is needed at all.
+	def compute_layout(self, mastis, font_size, dpi=72):
 		dpi_scale = dpi / 72.0 # NOTE: Validate this equation
 		font_scale = font_size * dpi_scale
+		if not mastis:
+			return LineLayout((), cairo.TextExtents(0, 0, 0, 0, 0, 0))
+
+		# Gather the glyph index and advance of every character at once.
+		codepoints = self.mastis_to_codepoints(mastis)
+		glyph_indexes = self.glyph_index_by_cp[codepoints]
+		advances_ems = self.advance_by_cp[codepoints]
+
+		# And the kerning between every adjacent pair of characters. NOTE:
+		# that kerning values are positive or negative as appropriate, so
+		# we simply add it all together with the advances.
+		compact_ids = self.compact_id_by_cp[codepoints]
+		kern_vals_ems = self.kern_matrix[compact_ids[:-1], compact_ids[1:]]
+
+		# The pen position of each glyph in em space is the sum of the
+		# advances (and kerning) of all of the glyphs before it. We don't
+		# handle vertical scripts, so there is no dy.
+		dx_ems = np.zeros(len(codepoints), dtype=np.int64)
+		np.cumsum(advances_ems[:-1] + kern_vals_ems, out=dx_ems[1:])
+
+		# convert from em space to pixel space relative to the pen location.
+		px_per_em = font_scale / self.units_per_em
+		x_px = dx_ems * px_per_em
+
+		# Only now make the cairo glyphs that indicate where to place each
+		# glyph.
+		glyphs = tuple(cairo.Glyph(glyph_index, x, 0.0) \
+			for glyph_index, x in zip(glyph_indexes.tolist(), x_px.tolist()))
+
+		# The ink extents are the union of the glyphs' bounding boxes at
+		# their pen positions (glyphs with no outline have empty boxes that
+		# fall out of the min and max), flipped into cairo's y down space.
+		x_advance = (dx_ems[-1] + advances_ems[-1]) * px_per_em
+		x_min = (dx_ems + self.x_min_by_cid[compact_ids]).min()
+		x_max = (dx_ems + self.x_max_by_cid[compact_ids]).max()
+		if x_min > x_max:
+			extents = cairo.TextExtents(0, 0, 0, 0, x_advance, 0)
+		else:
+			y_min = self.y_min_by_cid[compact_ids].min()
+			y_max = self.y_max_by_cid[compact_ids].max()
+			extents = cairo.TextExtents(x_min * px_per_em, -y_max * px_per_em, \
+				(x_max - x_min) * px_per_em, (y_max - y_min) * px_per_em, \
+				x_advance, 0)
+
+		return LineLayout(glyphs, extents)
+
+	# The same as compute_layout(), but lines already laid out are remembered
+	# in the layout cache. The glyphs are offset to the pen position (x, y),
+	# while the extents stay relative to it. A layout at the origin is the
+	# cached one itself, so it must not be modified.
+	def layout(self, mastis, font_size, dpi=72, x=0.0, y=0.0):
+		key = (mastis, font_size, dpi)
+		line_layout = self.layout_cache.get(key)
+		if line_layout is None:
+			line_layout = self.compute_layout(mastis, font_size, dpi)
+			self.layout_cache.put(key, line_layout)
+
+		if x == 0 and y == 0:
+			return line_layout
+		return LineLayout(tuple(cairo.Glyph(glyph.index, glyph.x + x, \
+			glyph.y + y) for glyph in line_layout.glyphs), line_layout.extents)
+
+	# The same as layout(), but placed at the current point of the cairo
+	# context, and only the glyphs are returned.
+	def layout_line(self, ctx, mastis, font_size, dpi=72):
 		x_pen, y_pen = ctx.get_current_point()
-		for pair in kpairs:
-			if (pair[1] is not None):
-				kern_val_ems = self.get_kerning_for_pair(pair[0], pair[1])
-			else:
-				kern_val_ems = 0
-
-			kern_val_ems = 0
-
-			current_glyph_index = self.get_glyph_index(pair[0])
-			current_glyph_name = self.get_glyph_name(pair[0])
-			current_glyph_width_ems = self.get_glyph_width(current_glyph_name)
-
-			#print(f"cglyph[{pair[0]}] width: {current_glyph_width_ems}, kerning: {pair[0]}:{pair[1]}/{kern_val_ems}, dx_ems: {dx_ems}, dy_ems: {dy_ems}, kvems: {kern_val_ems}")
-
-			# convert from em space to pixel space relative to the pen location.
-			# Note: specifically written this way to minimize floating error.
-			x_px = (dx_ems * font_scale) / self.units_per_em
-			y_px = (dy_ems * font_scale) / self.units_per_em
-			#print(f" '{pair[0]}': x_px: {x_px} y_px: {y_px}")
-			glyph = cairo.Glyph(current_glyph_index, x_pen + x_px, y_pen + y_px)
-			#print(f" glyph: {glyph}")
-			glayout.append(glyph)
-
-			# Now, figure out the advance and subtract the kerning for the
-			# placement of the next glyph in em space. NOTE: that kerning
-			# values are positive or negative as appropriate, so we simply
-			# add it all together.
-			dx_ems += current_glyph_width_ems + kern_val_ems
-			# We don't handle vertical scripts, so ignore dy_ems.
-			dy_ems = 0
-
-		# TODO: Need to also return extents of line (which include the kerning)
-		# as another value, that will make all kinds of other things easier.
-		# Like computing the proper image width, etc, etc.
-		return glayout
+		return list(self.layout(mastis, font_size, dpi, x_pen, y_pen).glyphs)
+
+	# The cairo style (ascent, descent, height, max_x_advance, max_y_advance)
+	# of the font at a size, in pixels, from the font's hhea metrics.
+	def get_font_extents(self, font_size, dpi=72):
+		px_per_em = font_size * (dpi / 72.0) / self.units_per_em
+		ascent = self.ascent * px_per_em
+		descent = -self.descent * px_per_em
+		return cairo.FontExtents(ascent, descent, \
+			ascent + descent + self.line_gap * px_per_em, \
+			self.max_advance * px_per_em, 0)
 
 # Useful standalone demonstration code for getting stuff out of ttLib.
 def debugging():
+	from fontTools import ttLib
 	tt = ttLib.TTFont(os.path.abspath("./KiThree.ttf"))
 	print("Loaded ./KiThree.ttf")
 
@@ -264,7 +750,69 @@ def kern_test():
 	del surface
 	print("Wrote image to hello.png")
 
+# Check the GPOS kerning against a small synthetic font whose one kern lookup
+# has a glyph pair (format 1) subtable followed by class pair (format 2)
+# subtables, since KiThree itself only has glyph pairs.
+def do_unit_test():
+	from fontTools import ttLib
+	from fontTools.fontBuilder import FontBuilder
+	from fontTools.pens.ttGlyphPen import TTGlyphPen
+	from fontTools.feaLib.builder import addOpenTypeFeaturesFromString
+
+	names = ['.notdef', 'a', 'b', 'c', 'd']
+	fb = FontBuilder(1000, isTTF=True)
+	fb.setupGlyphOrder(names)
+	fb.setupCharacterMap({ord(name): name for name in names[1:]})
+	fb.setupGlyf({name: TTGlyphPen(None).glyph() for name in names})
+	fb.setupHorizontalMetrics({name: (500, 0) for name in names})
+	fb.setupHorizontalHeader(ascent=800, descent=-200)
+	# The a c pair comes first, so it wins over the class pair covering it.
+	# d isn't in any left class at all, so it is class 0 of its subtable.
+	addOpenTypeFeaturesFromString(fb.font, """
+		@L = [a b];
+		@R = [b c];
+		feature kern {
+			pos a c 20;
+			pos @L @R -50;
+			pos d [a c] 7;
+		} kern;
+	""")
+	f = io.BytesIO()
+	fb.font.save(f)
+	f.seek(0)
+
+	kf = KiltaFont.__new__(KiltaFont)
+	kf.tt = ttLib.TTFont(f)
+	formats = [subtable.Format for lookup in \
+		kf.tt['GPOS'].table.LookupList.Lookup for subtable in lookup.SubTable]
+	compact_ids = {name: cid for cid, name in enumerate(names)}
+	matrix = kf.build_gpos_kerning_matrix(names, compact_ids)
+
+	expected = np.zeros((len(names), len(names)), dtype=np.int16)
+	for left, right, kern_val in (('a', 'c', 20), ('a', 'b', -50), \
+			('b', 'b', -50), ('b', 'c', -50), ('d', 'a', 7), ('d', 'c', 7)):
+		expected[compact_ids[left], compact_ids[right]] = kern_val
+
+	passed = 2 in formats and matrix is not None and \
+		np.array_equal(matrix, expected)
+	if not passed:
+		print(f"ERROR! GPOS kerning of subtable formats {formats} is:")
+		print(matrix)
+		print("but should be:")
+		print(expected)
+	print(f"GPOS class kerning test: {'passed' if passed else 'FAILED'}.")
+	return passed
+
 def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-t", "--test", \
+		help="Run internal test suite", \
+		action="store_true")
+	args = parser.parse_args()
+
+	if args.test:
+		return 0 if do_unit_test() else 1
+
 	# The state of this function is forever in some debugging state.
 
 	debugging()
@@ -276,7 +824,7 @@ def main():
 	#print(f"Kerning between'k' and 'i': {kf.get_kerning_for_pair('k', 'i')}")
 
 if __name__ == '__main__':
-	main()
+	os.sys.exit(main())
 
 
 
@@ -11,10 +11,390 @@ import collections
 import re
 import random as rnd
 import argparse
+import array
+import bisect
+import collections.abc
 import fileinput
+import hashlib
+import io
+import itertools
+import multiprocessing
+import os
 
 KToken = collections.namedtuple('KToken', ['typ', 'value', 'line', 'column'])
 
+# Flatten an encoding dict of token name to list of characters into a list of
+# strings indexed by token code.
+def build_encoding_table(names, encoding):
+	return [''.join(encoding.get(name, [])) for name in names]
+
+# A float in [0, 1) that is a well mixed function of a 64 bit seed and a
+# position. This is the splitmix64 finalizer.
+def position_hash(seed, pos):
+	x = (seed + (pos + 1) * 0x9e3779b97f4a7c15) & 0xffffffffffffffff
+	x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & 0xffffffffffffffff
+	x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & 0xffffffffffffffff
+	x = x ^ (x >> 31)
+	return x / 18446744073709551616.0
+
+# A size bounded least recently used map with hit and miss counters. It
+# holds at most max_entries entries (any number if None) and, if max_bytes
+# is given, at most that many bytes as measured by sizeof(key, value) of
+# each entry.
+class LRUCache:
+	def __init__(self, max_entries, max_bytes=None, sizeof=None):
+		if max_bytes is not None and sizeof is None:
+			raise ValueError('A byte budget needs a sizeof function')
+		self.max_entries = max_entries
+		self.max_bytes = max_bytes
+		self.sizeof = sizeof
+		self.entries = collections.OrderedDict()
+		self.sizes = {}
+		self.nbytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def __len__(self):
+		return len(self.entries)
+
+	def get(self, key, default=None):
+		value = self.entries.get(key, self)
+		if value is self:
+			self.misses += 1
+			return default
+		self.entries.move_to_end(key)
+		self.hits += 1
+		return value
+
+	def put(self, key, value):
+		self.pop(key)
+		self.entries[key] = value
+		if self.sizeof is not None:
+			self.sizes[key] = self.sizeof(key, value)
+			self.nbytes += self.sizes[key]
+		# Always keep the newest entry, even if it is over budget by itself.
+		while (self.max_entries is not None and \
+					len(self.entries) > self.max_entries) or \
+				(self.max_bytes is not None and \
+					self.nbytes > self.max_bytes and len(self.entries) > 1):
+			self.pop(next(iter(self.entries)))
+			self.evictions += 1
+
+	def pop(self, key, default=None):
+		self.nbytes -= self.sizes.pop(key, 0)
+		return self.entries.pop(key, default)
+
+	def clear(self):
+		self.entries.clear()
+		self.sizes.clear()
+		self.nbytes = 0
+
+	def hit_rate(self):
+		lookups = self.hits + self.misses
+		return self.hits / lookups if lookups else 0.0
+
+	def stats(self):
+		stats = {
+			'entries': len(self.entries),
+			'hits': self.hits,
+			'misses': self.misses,
+			'evictions': self.evictions,
+			'hit_rate': self.hit_rate(),
+		}
+		if self.sizeof is not None:
+			stats['bytes'] = self.nbytes
+		return stats
+
+# An immutable sequence of the tokens of a source string stored as parallel
+# arrays: the token codes as bytes, and the start offset into the source,
+# line, and column of each token as unsigned ints. Tokens always cover the
+# whole source back to back, so a token's value runs from its start to the
+# start of the next token. Indexing produces a KToken view on demand.
+class KTokenBuffer(collections.abc.Sequence):
+	def __init__(self, source, names):
+		if len(names) > 256:
+			raise ValueError('Too many token types to store as bytes')
+		self.source = source
+		self.names = names
+		self.codes = array.array('B')
+		self.starts = array.array('I')
+		self.lines = array.array('I')
+		self.columns = array.array('I')
+
+	def __len__(self):
+		return len(self.codes)
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return [self[i] for i in range(*index.indices(len(self)))]
+
+		count = len(self.codes)
+		if index < 0:
+			index += count
+		if index < 0 or index >= count:
+			raise IndexError('token index out of range')
+
+		start = self.starts[index]
+		end = self.starts[index + 1] if index + 1 < count else \
+			len(self.source)
+		return KToken(self.names[self.codes[index]], \
+			self.source[start:end], self.lines[index], self.columns[index])
+
+	def __iter__(self):
+		source = self.source
+		names = self.names
+		ends = itertools.chain(itertools.islice(self.starts, 1, None), \
+			(len(source),))
+		for code, start, end, line, column in zip(self.codes, self.starts, \
+				ends, self.lines, self.columns):
+			yield KToken(names[code], source[start:end], line, column)
+
+	# How many bytes the arrays (not the source string) take.
+	def nbytes(self):
+		return sum(a.itemsize * len(a) for a in \
+			(self.codes, self.starts, self.lines, self.columns))
+
+# A transliteration that remembers where each of its tokens started and the
+# mastis it turned into, so when the utterance is edited only the tokens
+# around the changed span need to be scanned again. Tokens outside of the
+# edit keep the mastis they had, so fixing a typo doesn't reshuffle the
+# UI_ALT choices elsewhere in the utterance.
+class KEditableTransliteration:
+	def __init__(self, tokenizer, utterance):
+		self.tokenizer = tokenizer
+		self.utterance = ''
+		self.starts = array.array('I')
+		self.pieces = []
+		self.edit(utterance)
+
+	def mastis(self):
+		return ''.join(self.pieces)
+
+	# Change the utterance to new_utterance, rescanning as little as possible.
+	# Returns how many tokens had to be scanned.
+	def edit(self, new_utterance):
+		old = self.utterance
+		new = new_utterance
+		tokenizer = self.tokenizer
+		scanner = tokenizer.scanner
+		table = tokenizer.mastis_table
+		alternates = tokenizer.mastis_alternates
+		choose = tokenizer.ui_alt_chooser(new)
+		# How far past its start a token's mastis depends on the utterance:
+		# the scanner's lookahead, and in deterministic mode the characters
+		# around a UI token its UI_ALT choice is hashed from.
+		context = tokenizer.ui_alt_context
+		lookahead = max(scanner.max_len, context + 2)
+
+		# The common prefix and suffix of the two versions.
+		limit = min(len(old), len(new))
+		prefix = 0
+		while prefix < limit and old[prefix] == new[prefix]:
+			prefix += 1
+		suffix = 0
+		while suffix < limit - prefix and \
+				old[len(old) - suffix - 1] == new[len(new) - suffix - 1]:
+			suffix += 1
+
+		# A token is decided from the characters before it through lookahead
+		# characters after its start, so the old tokens for which all of
+		# that is in the common prefix are still good.
+		keep = bisect.bisect_left(self.starts, prefix - lookahead)
+		rescan = self.starts[keep] if keep < len(self.starts) else len(old)
+
+		# Likewise, once a new token starts far enough into the common
+		# suffix that everything before it which it depends on is in there
+		# too, at the same place an old one did, the rest of the old tokens
+		# are still good, just shifted over.
+		old_suffix = len(old) - suffix
+		delta = len(new) - len(old)
+		starts = self.starts[:keep]
+		pieces = self.pieces[:keep]
+		resume = len(self.starts)
+		scanned = 0
+		for code, start, end in scanner.scan(new, rescan):
+			old_start = start - delta
+			if old_start > old_suffix + context:
+				index = bisect.bisect_left(self.starts, old_start, keep)
+				if index < len(self.starts) and \
+						self.starts[index] == old_start:
+					resume = index
+					break
+			scanned += 1
+			starts.append(start)
+			if code in alternates and choose(start):
+				pieces.append(alternates[code])
+			else:
+				pieces.append(table[code])
+
+		starts.extend(start + delta for start in self.starts[resume:])
+		pieces.extend(self.pieces[resume:])
+
+		self.utterance = new
+		self.starts = starts
+		self.pieces = pieces
+		return scanned
+
+# Python's regex \w for str patterns, which is what \b is defined against.
+def is_word_char(c):
+	return c.isalnum() or c == '_'
+
+# A longest-match scanner over a trie of the literal spellings described by a
+# token specification. The specification is the same list of (name, regex)
+# pairs the regex tokenizer uses, but every regex must be either '.' (the
+# catch all) or a sequence of single character classes like '[Nn][Ëë]',
+# optionally surrounded by \b. Each character class is expanded into the
+# trie, so case folding costs nothing at scan time.
+#
+# Longest match is equivalent to the regex's first match here because the
+# specification always lists the longer spellings before their prefixes. The
+# \b bounded tokens (TOPIC, ATTR, TEN) win over anything else of the same
+# length, just like they do by being listed first in the regex.
+class KiltaScanner:
+	def __init__(self, token_specification):
+		# Token codes are indexes into this list.
+		self.names = [name for name, regex in token_specification]
+		self.codes = {name: code for code, name in enumerate(self.names)}
+		self.unk = None
+
+		# Each trie node is a list of:
+		# [code, bounded code, {char: child node}]
+		# where either code may be None if no token ends at that node.
+		self.root = {}
+		self.max_len = 1
+
+		for name, regex in token_specification:
+			code = self.codes[name]
+			if regex == '.':
+				self.unk = code
+				continue
+
+			bounded = regex.startswith(r'\b') and regex.endswith(r'\b')
+			if bounded:
+				regex = regex[2:-2]
+
+			classes = re.findall(r'\[([^\]]+)\]', regex)
+			if ''.join('[%s]' % c for c in classes) != regex:
+				raise RuntimeError('Unsupported token regex %r for %s' \
+					%(regex, name))
+			classes = [c.replace('\\n', '\n').replace('\\t', '\t') \
+				for c in classes]
+			self.max_len = max(self.max_len, len(classes))
+
+			# Every spelling of this token becomes a path through the trie.
+			level = [self.root]
+			for chars in classes:
+				nodes = [children.setdefault(c, [None, None, {}]) \
+					for children in level for c in chars]
+				level = [node[2] for node in nodes]
+			slot = 1 if bounded else 0
+			for node in nodes:
+				# First one listed wins, like the regex alternation.
+				if node[slot] is None:
+					node[slot] = code
+
+		if self.unk is None:
+			raise RuntimeError('Token specification has no catch all')
+
+	# Yield (code, start, end) for every token in s from pos onwards that
+	# starts before stop. A token starting before stop may still look at (and
+	# extend over) up to max_len characters past it, plus one more for \b.
+	def scan(self, s, pos=0, stop=None):
+		root = self.root
+		unk = self.unk
+		n = len(s)
+		if stop is None:
+			stop = n
+		while pos < stop:
+			node = root.get(s[pos])
+			if node is None:
+				yield (unk, pos, pos + 1)
+				pos += 1
+				continue
+
+			start = pos
+			code = None
+			pos += 1
+			while True:
+				if node[1] is not None and \
+						self.is_bounded(s, start, pos):
+					code = node[1]
+					end = pos
+				elif node[0] is not None:
+					code = node[0]
+					end = pos
+				children = node[2]
+				if not children or pos >= n:
+					break
+				node = children.get(s[pos])
+				if node is None:
+					break
+				pos += 1
+
+			if code is None:
+				code = unk
+				end = start + 1
+			yield (code, start, end)
+			pos = end
+
+	# The same walk as scan(), fused with the conversion of each token to its
+	# encoding so no token objects, tuples, or positions beyond the start of
+	# the token are ever materialized. The table is indexed by token code.
+	# For a code in alternates, choose(start) is asked whether to use the
+	# alternate encoding instead.
+	def transliterate(self, s, table, alternates, choose):
+		root = self.root
+		unk_enc = table[self.unk]
+		out = []
+		append = out.append
+		n = len(s)
+		pos = 0
+		while pos < n:
+			node = root.get(s[pos])
+			if node is None:
+				append(unk_enc)
+				pos += 1
+				continue
+
+			start = pos
+			code = None
+			pos += 1
+			while True:
+				if node[1] is not None and \
+						self.is_bounded(s, start, pos):
+					code = node[1]
+					end = pos
+				elif node[0] is not None:
+					code = node[0]
+					end = pos
+				children = node[2]
+				if not children or pos >= n:
+					break
+				node = children.get(s[pos])
+				if node is None:
+					break
+				pos += 1
+
+			if code is None:
+				append(unk_enc)
+				pos = start + 1
+				continue
+			if code in alternates and choose(start):
+				append(alternates[code])
+			else:
+				append(table[code])
+			pos = end
+
+		return ''.join(out)
+
+	# Does s[start:end] have a \b on both sides?
+	def is_bounded(self, s, start, end):
+		before = start > 0 and is_word_char(s[start - 1])
+		after = end < len(s) and is_word_char(s[end])
+		return before != is_word_char(s[start]) and \
+			after != is_word_char(s[end - 1])
+
 class KiltaTokenizer:
 	# The Key is a lexical TOKEN type, 
 	# The Value is a list of encodings that represents it in the Mastis 
@@ -110,95 +490,170 @@ class KiltaTokenizer:
 
 	}
 
+	# The lexical specification used to cut apart the Kílta into tokens that
+	# affect Mastis rendering. Order matters: the first alternative that
+	# matches at a position wins.
+	token_specification = [
+		# Special grammatical markers
+		('TOPIC',		r'\b[Nn][Ëë]\b'),
+		('ATTR',		r'\b[Vv][Ëë]\b'),
+
+		# Dipthongs
+		('AU',			r'[Aa][Uu]'),
+		('AI',			r'[Aa][Ii]'),
+
+		# Not dipthongs, but affects Mastis rendering
+		('UI',			r'[Uu][Ii]'),
+
+		# Vowels
+		('SHORT_I',		r'[Ii]'),
+		('LONG_I',		r'[Íí]'),
+		('SHORT_U',		r'[Uu]'),
+		('LONG_U',		r'[Úú]'),
+		('SHORT_E',		r'[Ee]'),
+		('LONG_E',		r'[Éé]'),
+		('SHORT_O',		r'[Oo]'),
+		('LONG_O',		r'[Óó]'),
+		('MID_E',		r'[Ëë]'),
+		('SHORT_A',		r'[Aa]'),
+		('LONG_A',		r'[Áá]'),
+
+		# Doubled consonants and nasal allophony which affects rendering.
+		('CCH',			r'[Cc][Cc][Hh]'),
+		('KKW',			r'[Kk][Kk][Ww]'),
+		('PP',			r'[Pp][Pp]'),
+		('MM',			r'[Mm][Mm]'),
+		('TT',			r'[Tt][Tt]'),
+		('SS',			r'[Ss][Ss]'),
+		('NKW',			r'[Nn][Kk][Ww]'), # nasal allophony cluster
+		('NHW',			r'[Nn][Hh][Ww]'), # nasal allophony cluster
+		('NK',			r'[Nn][Kk]'), # nasal allophony cluster
+		('NH',			r'[Nn][Hh]'), # nasal allophony cluster
+		('NN',			r'[Nn][Nn]'),
+		('RR',			r'[Rr][Rr]'),
+		('LL',			r'[Ll][Ll]'),
+		('KK',			r'[Kk][Kk]'),
+
+		# Single Consonants 
+		('P',			r'[Pp]'),
+		('V',			r'[Vv]'),
+		('M',			r'[Mm]'),
+		('T',			r'[Tt]'),
+		('S',			r'[Ss]'),
+		('N',			r'[Nn]'),
+		('R',			r'[Rr]'),
+		('L',			r'[Ll]'),
+		('CH',			r'[Cc][Hh]'),
+		('KW',			r'[Kk][Ww]'), # precedence order...
+		('K',			r'[Kk]'),
+		('HW',			r'[Hh][Ww]'), # precedence order...
+		('H',			r'[Hh]'),
+
+		# Digits
+		('TEN',			r'\b[1][0]\b'),
+		('ONE', 		r'[1]'),
+		('TWO', 		r'[2]'),
+		('THREE', 		r'[3]'),
+		('FOUR', 		r'[4]'),
+		('FIVE', 		r'[5]'),
+		('SIX', 		r'[6]'),
+		('SEVEN', 		r'[7]'),
+		('EIGHT', 		r'[8]'),
+		('NINE', 		r'[9]'),
+
+		# Punctuation
+		('PERIOD', 		r'[.]'),
+		('COMMA', 		r'[,]'),
+		('EXCLAMATION',	r'[!]'),
+		('QUESTION',	r'[?]'),
+		('COLON',		r'[:]'),
+		('SEMI',		r'[;]'),
+		('SECTION',		r'[%]'), # TODO: Extension, ask wm about it.
+
+		# We want to specifically keep track of whitespace and what kind.
+		('NEWLINE',		r'[\n]'),
+		('SPACE',		r'[ ]'),
+		('TAB',			r'[\t]'),
+
+		('UNK',			r'.'),		# anything else we don't know.
+	]
+	# Built once per process from token_specification. See KiltaScanner.
+	scanner = KiltaScanner(token_specification)
+
+	# The mastis encoding of each token, as a string, indexed by token code.
+	mastis_table = build_encoding_table(scanner.names, mastis_encoding)
+
+	# Token code to the encoding it is sometimes exchanged with.
+	mastis_alternates = {
+		scanner.codes['UI']: ''.join(mastis_encoding['UI_ALT']),
+	}
+
+	# How many characters on either side of a UI token its deterministic
+	# UI_ALT choice depends on.
+	ui_alt_context = 4
+
 	# A lexical analyzer to cut apart the Kílta into token that affect
 	# Mastis rendering.
 	def tokenize(self, s):
-		token_specification = [
-			# Special grammatical markers
-			('TOPIC',		r'\b[Nn][Ëë]\b'),
-			('ATTR',		r'\b[Vv][Ëë]\b'),
-
-			# Dipthongs
-			('AU',			r'[Aa][Uu]'),
-			('AI',			r'[Aa][Ii]'),
-
-			# Not dipthongs, but affects Mastis rendering
-			('UI',			r'[Uu][Ii]'),
-
-			# Vowels
-			('SHORT_I',		r'[Ii]'),
-			('LONG_I',		r'[Íí]'),
-			('SHORT_U',		r'[Uu]'),
-			('LONG_U',		r'[Úú]'),
-			('SHORT_E',		r'[Ee]'),
-			('LONG_E',		r'[Éé]'),
-			('SHORT_O',		r'[Oo]'),
-			('LONG_O',		r'[Óó]'),
-			('MID_E',		r'[Ëë]'),
-			('SHORT_A',		r'[Aa]'),
-			('LONG_A',		r'[Áá]'),
-
-			# Doubled consonants and nasal allophony which affects rendering.
-			('CCH',			r'[Cc][Cc][Hh]'),
-			('KKW',			r'[Kk][Kk][Ww]'),
-			('PP',			r'[Pp][Pp]'),
-			('MM',			r'[Mm][Mm]'),
-			('TT',			r'[Tt][Tt]'),
-			('SS',			r'[Ss][Ss]'),
-			('NKW',			r'[Nn][Kk][Ww]'), # nasal allophony cluster
-			('NHW',			r'[Nn][Hh][Ww]'), # nasal allophony cluster
-			('NK',			r'[Nn][Kk]'), # nasal allophony cluster
-			('NH',			r'[Nn][Hh]'), # nasal allophony cluster
-			('NN',			r'[Nn][Nn]'),
-			('RR',			r'[Rr][Rr]'),
-			('LL',			r'[Ll][Ll]'),
-			('KK',			r'[Kk][Kk]'),
-
-			# Single Consonants 
-			('P',			r'[Pp]'),
-			('V',			r'[Vv]'),
-			('M',			r'[Mm]'),
-			('T',			r'[Tt]'),
-			('S',			r'[Ss]'),
-			('N',			r'[Nn]'),
-			('R',			r'[Rr]'),
-			('L',			r'[Ll]'),
-			('CH',			r'[Cc][Hh]'),
-			('KW',			r'[Kk][Ww]'), # precedence order...
-			('K',			r'[Kk]'),
-			('HW',			r'[Hh][Ww]'), # precedence order...
-			('H',			r'[Hh]'),
-
-			# Digits
-			('TEN',			r'\b[1][0]\b'),
-			('ONE', 		r'[1]'),
-			('TWO', 		r'[2]'),
-			('THREE', 		r'[3]'),
-			('FOUR', 		r'[4]'),
-			('FIVE', 		r'[5]'),
-			('SIX', 		r'[6]'),
-			('SEVEN', 		r'[7]'),
-			('EIGHT', 		r'[8]'),
-			('NINE', 		r'[9]'),
-
-			# Punctuation
-			('PERIOD', 		r'[.]'),
-			('COMMA', 		r'[,]'),
-			('EXCLAMATION',	r'[!]'),
-			('QUESTION',	r'[?]'),
-			('COLON',		r'[:]'),
-			('SEMI',		r'[;]'),
-			('SECTION',		r'[%]'), # TODO: Extension, ask wm about it.
-
-			# We want to specifically keep track of whitespace and what kind.
-			('NEWLINE',		r'[\n]'),
-			('SPACE',		r'[ ]'),
-			('TAB',			r'[\t]'),
-
-			('UNK',			r'.'),		# anything else we don't know.
-		]
+		scanner = self.scanner
+		names = scanner.names
+		line = 1
+		line_start = 0
+		for code, start, end in scanner.scan(s):
+			typ = names[code]
+			if typ == 'NEWLINE':
+				line_start = start
+				line += 1
+
+			yield KToken(typ, s[start:end], line, start-line_start)
+
+	# Like tokenize(), but reads the text from a text file object f in
+	# chunk_size pieces, so memory use stays constant no matter how large
+	# the input is. Tokens that straddle a chunk boundary, and the \b rules
+	# which look one character past either end of a token, are handled by
+	# holding back the tail of the buffer until the next chunk arrives.
+	# Line and column numbers are global to the whole stream.
+	def tokenize_stream(self, f, chunk_size=65536):
+		scanner = self.scanner
+		names = scanner.names
+		# How much lookahead a token needs past its start to be decided.
+		holdback = scanner.max_len
+		line = 1
+		line_start = 0
+		# buf[0] is at this position in the stream.
+		offset = 0
+		buf = ''
+		pos = 0
+		eof = False
+		while not eof:
+			chunk = f.read(chunk_size)
+			eof = not chunk
+			buf += chunk
+			stop = len(buf) if eof else len(buf) - holdback
+			for code, start, end in scanner.scan(buf, pos, stop):
+				typ = names[code]
+				if typ == 'NEWLINE':
+					line_start = offset + start
+					line += 1
+
+				yield KToken(typ, buf[start:end], line, \
+					offset + start - line_start)
+
+				pos = end
+
+			# Drop what we've consumed, but keep the character before pos
+			# around since \b needs to see it.
+			cut = max(pos - 1, 0)
+			buf = buf[cut:]
+			offset += cut
+			pos -= cut
+
+	# The original regex based lexical analyzer. The scanner above must
+	# produce exactly the same token stream, and this is kept around as the
+	# reference implementation to check that against.
+	def tokenize_regex(self, s):
 		tok_regex = '|'.join('(?P<%s>%s)' % \
-			pair for pair in token_specification)
+			pair for pair in self.token_specification)
 		get_token = re.compile(tok_regex).match
 		line = 1
 		pos = line_start = 0
@@ -219,26 +674,122 @@ class KiltaTokenizer:
 			raise RuntimeError('Unexpected character %r on line %d' \
 				%(s[pos], line))
 
-	# A means to simply convert the tokenizer's iterable into an immediate list.
+	# Eagerly tokenize all of s. This returns a KTokenBuffer, which can be
+	# used like the list of KTokens tokenize() would produce but stores them
+	# in a handful of compact arrays.
 	def tokenize_all(self, s):
-		return [token for token in self.tokenize(s)]
+		scanner = self.scanner
+		buf = KTokenBuffer(s, scanner.names)
+		add_code = buf.codes.append
+		add_start = buf.starts.append
+		add_line = buf.lines.append
+		add_column = buf.columns.append
+		newline = scanner.codes['NEWLINE']
+		line = 1
+		line_start = 0
+		for code, start, end in scanner.scan(s):
+			if code == newline:
+				line_start = start
+				line += 1
+			add_code(code)
+			add_start(start)
+			add_line(line)
+			add_column(start - line_start)
+		return buf
 	
 	def token_to_mastis(self, token_type):
 		if token_type in self.mastis_encoding:
 			return self.mastis_encoding[token_type]
 		return []
 
+	# The rng is anything with a random() method returning a float in [0, 1)
+	# and is used for the UI_ALT choices. It defaults to the random module.
+	#
+	# If deterministic is True, the rng isn't used at all. Instead each
+	# UI_ALT choice is derived from a hash of the UI token and the
+	# ui_alt_context characters on either side of it, so the same utterance
+	# always produces the same mastis, and editing one part of an utterance
+	# never changes the choices elsewhere in it. Only then can translations
+	# be memoized, and memo_size > 0 keeps an LRU memo of that many
+	# utterance -> mastis translations.
+	def __init__(self, rng=None, deterministic=False, memo_size=0):
+		self.rng = rnd if rng is None else rng
+		self.deterministic = deterministic
+		self.memo = None
+		if memo_size > 0:
+			if not deterministic:
+				raise ValueError('A memo requires deterministic translation')
+			self.memo = LRUCache(memo_size)
+
 	# Convert the utterance from the romanized version to the mastis encoding.
 	def romanized_to_mastis(self, utterance):
+		return next(self.romanized_to_mastis_many((utterance,)))
+
+	# Convert each utterance in an iterable from the romanized version to the
+	# mastis encoding, yielding them in order. Every utterance shares the one
+	# scanner and the tokenizer's rng (or memo). The utterances are pulled
+	# from the iterable one at a time, so a huge (or lazily produced) input is
+	# streamed through without ever being held in memory all at once.
+	def romanized_to_mastis_many(self, utterances):
+		transliterate = self.transliterate
+		if self.memo is not None:
+			transliterate = self.transliterate_memoized
+
+		for utterance in utterances:
+			yield transliterate(utterance)
+
+	# This goes straight from the text to the mastis string through the
+	# scanner using token codes and the precomputed mastis_table.
+	def transliterate(self, utterance):
+		return self.scanner.transliterate(utterance, self.mastis_table, \
+			self.mastis_alternates, self.ui_alt_chooser(utterance))
+
+	def transliterate_memoized(self, utterance):
+		mastis = self.memo.get(utterance)
+		if mastis is None:
+			mastis = self.transliterate(utterance)
+			self.memo.put(utterance, mastis)
+		return mastis
+
+	# Like transliterate(), but returns a KEditableTransliteration which can
+	# be cheaply brought up to date when the utterance is edited.
+	def transliterate_editable(self, utterance):
+		return KEditableTransliteration(self, utterance)
+
+	# Return a function of the position of a UI token in the utterance that
+	# says whether to exchange it with UI_ALT.
+	def ui_alt_chooser(self, utterance):
+		if not self.deterministic:
+			return self.choose_ui_alt
+
+		context = self.ui_alt_context
+		def choose(pos):
+			start = max(pos - context, 0)
+			seed = int.from_bytes(hashlib.blake2b( \
+				utterance[start:pos + 2 + context].encode('utf-8'), \
+				digest_size=8).digest(), 'little')
+			return position_hash(seed, pos - start) <= .10
+		return choose
+
+	# Handle the (guessed) probabilities for UI_ALT
+	def choose_ui_alt(self, pos):
+		return self.rng.random() <= .10
+
+	# The token stream based conversion. This is what romanized_to_mastis()
+	# used to be and is kept as the reference it is checked against.
+	def romanized_to_mastis_tokens(self, utterance):
 		mastis_encodings = []
+		choose_ui_alt = self.ui_alt_chooser(utterance)
+		pos = 0
 		for token in self.tokenize(utterance):
 			typ = token.typ
 			# Handle the (guessed) probabilities for UI_ALT
 			if typ == 'UI':
-				if rnd.random() <= .10:
+				if choose_ui_alt(pos):
 					typ = 'UI_ALT'
 			enc = self.token_to_mastis(typ)
 			mastis_encodings.extend(enc);
+			pos += len(token.value)
 
 		# join array into a string
 		return "".join(mastis_encodings)
@@ -280,17 +831,135 @@ def do_unit_test():
 	if token_count != len(ret):
 		print("ERROR! The lazy and eager versions differed!")
 
-def do_file_or_stdin():
-	kt = KiltaTokenizer()
-	for line in fileinput.input():
-		ret = kt.romanized_to_mastis(line.rstrip())
-		print(ret)
+	do_differential_test(kt)
+
+# Check the trie scanner against the reference regex tokenizer on a pile of
+# random strings built from pieces that exercise every token, the \b rules
+# around në, vë, and 10, case folding, and characters we know nothing about.
+def do_differential_test(kt, trials=2000, seed=0):
+	pieces = [
+		'a', 'á', 'cch', 'ch', 'e', 'é', 'ë', 'h', 'hw', 'i', 'í', 'k', 'kk',
+		'kw', 'kkw', 'l', 'll', 'm', 'mm', 'n', 'nn', 'o', 'ó', 'p', 'pp',
+		'r', 'rr', 's', 'ss', 't', 'tt', 'u', 'ú', 'v', 'nk', 'nkw', 'nh',
+		'nhw', 'au', 'ai', 'ui', 'në', 'vë', 'NË', 'Vë', '10', '1', '0',
+		'2', '9', '.', ',', '!', '?', ':', ';', '%', '-', '_', '\n', ' ',
+		'\t', '\r', 'c', 'x', 'İ', 'ß', '日', '²', 'Ä',
+	]
+	r = rnd.Random(seed)
+	dkt = KiltaTokenizer(deterministic=True, memo_size=64)
+	failures = 0
+	for trial in range(trials):
+		s = ''.join(r.choice(pieces) for i in range(r.randint(0, 40)))
+		if r.random() < .5:
+			s = s.upper()
+		if list(kt.tokenize(s)) != list(kt.tokenize_regex(s)):
+			failures += 1
+			print(f"ERROR! Scanner and regex tokenizer differ on: {s!r}")
+			continue
+		tokens = kt.tokenize_all(s)
+		if list(tokens) != list(kt.tokenize(s)) or \
+				[tokens[i] for i in range(-len(tokens), len(tokens))] != \
+				list(tokens) * 2:
+			failures += 1
+			print(f"ERROR! Token buffer differs on: {s!r}")
+			continue
+		chunk_size = r.randint(1, 8)
+		if list(kt.tokenize_stream(io.StringIO(s), chunk_size)) != \
+				list(kt.tokenize(s)):
+			failures += 1
+			print(f"ERROR! Streaming tokenizer with chunk size {chunk_size} "
+				f"differs on: {s!r}")
+			continue
+		editable = dkt.transliterate_editable(s)
+		editable.edit(s[::-1])
+		editable.edit(s)
+		if editable.mastis() != dkt.romanized_to_mastis(s):
+			failures += 1
+			print(f"ERROR! Editable transliteration differs on: {s!r}")
+			continue
+		# And a small edit somewhere in the middle, which only rescans the
+		# tokens around it.
+		pos = r.randint(0, len(s))
+		t = s[:pos] + r.choice(pieces) + s[pos + r.randint(0, 2):]
+		editable = dkt.transliterate_editable(s)
+		editable.edit(t)
+		if editable.mastis() != dkt.romanized_to_mastis(t):
+			failures += 1
+			print(f"ERROR! Editable transliteration differs on: {s!r} " \
+				f"edited to {t!r}")
+			continue
+		rnd.seed(trial)
+		fused = kt.romanized_to_mastis(s)
+		rnd.seed(trial)
+		if fused != kt.romanized_to_mastis_tokens(s):
+			failures += 1
+			print(f"ERROR! Fused and token transliteration differ on: {s!r}")
+			continue
+		fused = dkt.romanized_to_mastis(s)
+		if fused != dkt.romanized_to_mastis_tokens(s) or \
+				fused != dkt.romanized_to_mastis(s):
+			failures += 1
+			print(f"ERROR! Deterministic transliteration differs on: {s!r}")
+	print(f"Differential test: {trials - failures}/{trials} passed.")
+	print(f"Deterministic memo: {dkt.memo.stats()}")
+	return failures == 0
+
+# Translate a list of romanized lines in a worker process.
+def translate_lines(lines, deterministic=False):
+	kt = KiltaTokenizer(deterministic=deterministic)
+	return list(kt.romanized_to_mastis_many(lines))
+
+# Cut the lines of the files (- for stdin) into lists of chunk_lines lines.
+def read_line_chunks(files, chunk_lines):
+	chunk = []
+	for line in fileinput.input(files):
+		chunk.append(line.rstrip())
+		if len(chunk) == chunk_lines:
+			yield chunk
+			chunk = []
+	if chunk:
+		yield chunk
+
+def do_file_or_stdin(files="-", jobs=1, chunk_lines=1024, \
+		deterministic=False):
+	if jobs <= 1:
+		kt = KiltaTokenizer(deterministic=deterministic)
+		lines = (line.rstrip() for line in fileinput.input(files))
+		for ret in kt.romanized_to_mastis_many(lines):
+			print(ret)
+		return
+
+	# Hand out chunks to the pool, but only keep a couple of chunks per
+	# worker in flight so a huge input is never read into memory all at
+	# once. Results are written in the original order as soon as the
+	# oldest outstanding chunk is done.
+	in_flight = jobs * 2
+	pending = collections.deque()
+	with multiprocessing.Pool(jobs) as pool:
+		for chunk in read_line_chunks(files, chunk_lines):
+			pending.append(pool.apply_async(translate_lines, \
+				(chunk, deterministic)))
+			if len(pending) >= in_flight:
+				print("\n".join(pending.popleft().get()))
+		while pending:
+			print("\n".join(pending.popleft().get()))
 
 def main():
 	parser = argparse.ArgumentParser()
 	parser.add_argument("-t", "--test", \
 		help="Run internal test suite", \
 		action="store_true")
+	parser.add_argument("-j", "--jobs", \
+		help="Translate with this many processes, 0 for one per cpu", \
+		type=int, \
+		default=1)
+	parser.add_argument("-d", "--deterministic", \
+		help="Always translate the same line to the same mastis", \
+		action="store_true")
+	parser.add_argument("--chunk-lines", \
+		help="Lines of input handed to a process at a time", \
+		type=int, \
+		default=1024)
 	parser.add_argument("file", \
 		help="File to translate, stdin otherwise", \
 		nargs="*", \
@@ -300,7 +969,9 @@ def main():
 	if (args.test):
 		do_unit_test()
 	else:
-		do_file_or_stdin()
+		jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+		do_file_or_stdin(args.file, jobs, max(args.chunk_lines, 1), \
+			args.deterministic)
 
 if __name__ == '__main__':
 	main()
@@ -21,28 +21,33 @@
 # Crappy instructions to install:
 # sudo apt install python3-dotenv
 # pip3 install -U discord.py
-# pip3 install -U fs
 # pip3 install -U pycairo
 # pip3 install -U fonttools
+# pip3 install -U numpy
 # python3 mastis-bot.py
 
+import time
+STARTUP_BEGIN = time.perf_counter()
+
 import os
 import re
+import argparse
 import datetime as dt
-import pytz
+import io
 import discord
 import asyncio
+import concurrent.futures
 import math
-import cairo
 import textwrap as tw
 from dotenv import load_dotenv
 from datetime import date
-from fs.memoryfs import MemoryFS
-import font_helper as fh
 import kilta_utils as ku
-import kilta_date as kd
-import kilta_font as kf
-import archive as ardb
+import mastis_render as mr
+
+# NOTE: cairo, fontTools (through kilta_font), pytz (through archive and
+# kilta_date) and friends are slow to import and aren't needed until the
+# first command that uses them, or the font load which happens while we log
+# in, so they are imported where they are used instead of here.
 
 load_dotenv()
 
@@ -53,9 +58,73 @@ GUILD_NAME = os.getenv("DISCORD_GUILD_NAME")
 CHANNEL_NAME = os.getenv("DISCORD_CHANNEL_NAME")
 MASTIS_FONT = os.path.abspath(os.getenv("MASTIS_FONT"))
 
+# How many processes render .m commands (with 0, they are rendered on the
+# event loop itself), how many renders may be waiting at once before we
+# turn more away, and how many seconds a render may take.
+RENDER_PROCESSES = int(os.getenv("MASTIS_RENDER_PROCESSES", os.cpu_count() or 1))
+RENDER_QUEUE_DEPTH = int(os.getenv("MASTIS_RENDER_QUEUE_DEPTH", 32))
+RENDER_TIMEOUT_SECONDS = float(os.getenv("MASTIS_RENDER_TIMEOUT", 30))
+
+# How many bytes of rendered PNG images to remember, so a translation
+# people repeat doesn't have to be rendered again.
+RENDER_CACHE_BYTES = \
+  int(os.getenv("MASTIS_RENDER_CACHE_BYTES", 32 * 1024 * 1024))
+
+# Where rendered PNG images are kept on disk across restarts, how many bytes
+# of them to keep, and how many of the most requested ones to load into
+# memory when starting.
+RENDER_CACHE_DIR = os.getenv("MASTIS_RENDER_CACHE_DIR", "kilta_render_cache")
+RENDER_DISK_CACHE_BYTES = \
+  int(os.getenv("MASTIS_RENDER_DISK_CACHE_BYTES", 512 * 1024 * 1024))
+RENDER_CACHE_WARM_UP = int(os.getenv("MASTIS_RENDER_CACHE_WARM_UP", 256))
+
+# How long to gather up the renders found in memory before telling the render
+# cache on disk they were asked for again, all at once.
+RENDER_CACHE_TOUCH_SECONDS = 5.0
+
+# How many utterance -> mastis translations to remember.
+TRANSLATION_MEMO_SIZE = 4096
+
+# How many .m commands we remember enough about to cheaply redo when edited.
+M_EDIT_STATES = 256
+
+# How long a message must stay unedited before we redo its command, so a
+# burst of quick edits only gets rendered once.
+EDIT_DEBOUNCE_SECONDS = 1.5
+
+# How often we look to see if MASTIS_FONT changed, so a new version of the
+# font can be swapped in without restarting.
+FONT_WATCH_SECONDS = 5.0
+
+# ############################
+# How long each phase of starting up took, printed once the bot is ready if
+# asked for with --startup-profile.
+class StartupProfile:
+  def __init__(self, begin):
+    self.begin = begin
+    self.enabled = False
+    # Pairs of (phase name, seconds)
+    self.phases = []
+
+  def add(self, phase, seconds):
+    self.phases.append((phase, seconds))
+
+  def report(self):
+    lines = ["Startup profile:"]
+    for phase, seconds in self.phases:
+      lines.append(f" - {phase}: {seconds * 1000.0:.1f} ms")
+    total = time.perf_counter() - self.begin
+    lines.append(f" - total until ready: {total * 1000.0:.1f} ms")
+    return "\n".join(lines)
+
+startup_profile = StartupProfile(STARTUP_BEGIN)
+startup_profile.add("imports", time.perf_counter() - STARTUP_BEGIN)
+
 
 # ############################
 def do_cairo():
+  import cairo
+
   WIDTH, HEIGHT = 32, 32
 
   surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, WIDTH, HEIGHT)
@@ -85,136 +154,62 @@ def do_cairo():
   ctx.set_line_width(0.02)
   ctx.stroke()
 
-  # Prepare an _in memory_ file system and write the image to a file.
-  memfs = MemoryFS()
-  with memfs.open("translation.png", "wb") as fout:
-    surface.write_to_png(fout)
+  # Write the image to an in memory file, whose bytes we hand back.
+  fout = io.BytesIO()
+  surface.write_to_png(fout)
 
   del ctx
   surface.finish()
   del surface
 
-  return memfs
+  return fout.getvalue()
 
 # ############################
 def do_layout_test(self):
   pass
 
 # ############################
-# This is horrible. Sorry.
-def do_translate(self, msg):
-  # fixed width assumption, or at least maximum constraint
-  font_size = 30
-  font_vertical_padding = 3
-  lines = msg.splitlines()
-  max_cols = len(max(lines, key=len))
-  max_lines = msg.count('\n')
-  line_extents = []
-
-  # ############################
-  # First, we figure out a surface we KNOW is large enough to render the
-  # text. This ensures that the text doesn't fall off the edges of the
-  # image and confuse our computations.
-  # ############################
-  WIDTH = max_cols * font_size
-  HEIGHT = (max_lines + 1) * (font_size + font_vertical_padding)
-
-  # ############################
-  # Now make a surface so we can find the text extents of each line.
-  # ############################
-  surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, WIDTH, HEIGHT)
-  ctx = cairo.Context(surface)
-
-  #ctx.select_font_face("DejaVu Sans Mono", cairo.FONT_SLANT_NORMAL, \
-  #  cairo.FONT_WEIGHT_NORMAL)
-  ctx.set_font_face(self.kilta_font.get_cairo_font_face())
-  ctx.set_font_size(font_size)
-  # font_extents is (ascent, descent, height, max_x_advance, max_y_advance)
-  font_extents = ctx.font_extents()
-
-  # We act as if we draw the lines over each other cause it doesn't matter
-  # for extent calculation. But we move to the middle of the surface for
-  # safety.
-  for line in lines:
-    ctx.move_to(0, HEIGHT / 2)
-    glyph_line = self.kilta_font.layout_line(ctx, line, font_size)
-    # Note I still store the old 'line' here too. I'll need it later
-    # when doing the pen position.
-    line_extents.append([line, ctx.glyph_extents(glyph_line)])
-
-  # Clean up cause we're dumping this surface and context now!
-  del ctx
-  surface.finish()
-  del surface
-
-  # ############################
-  # Recompute the correct size of the surface.
-  # ############################
-  WIDTH = 0
-  HEIGHT = 0
-  for line_extent in line_extents:
-    extent = line_extent[1]
-    WIDTH = max(math.ceil(extent.width), WIDTH)
-    # TODO: Computation of height needs a reckoning.
-    HEIGHT += max(font_size, math.ceil(extent.height)) + \
-          font_vertical_padding
-  # TODO: in the next line, 3 is Wrong(tm). Need to figure out the x_advance
-  # of the last character on the longest line above and use that here.
-  WIDTH = math.ceil(WIDTH + 3)
-  # ..and add font's average descent to entail the last line's descenders.
-  HEIGHT = math.ceil(HEIGHT + font_extents[1])
-
-  # ############################
-  # Now finally we can reallocate a new surface that is exactly what we need
-  # to draw the text.
-  # ############################
+# Make a discord.File to upload from an attachment, which is a tuple of
+# (source, filename) where the source is either a bytes-like buffer or a
+# binary file object to read.
+def make_discord_file(attachment):
+  source, dfilename = attachment
+  if isinstance(source, (bytes, bytearray, memoryview)):
+    # NOTE: A BytesIO shares the memory of a bytes object it is made from
+    # until somebody writes to it, so the image isn't copied again.
+    source = io.BytesIO(source)
+  return discord.File(source, dfilename)
 
-  surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, WIDTH, HEIGHT)
-  ctx = cairo.Context(surface)
-
-  ctx.set_source_rgba(1.0, 1.0, 1.0, 1.0) # background: white
-  ctx.rectangle(0, 0, WIDTH, HEIGHT)
-  ctx.fill()
-
-  # ############################
-  # And finally render the text!
-  # ############################
-  #ctx.select_font_face("DejaVu Sans Mono", cairo.FONT_SLANT_NORMAL, \
-  #  cairo.FONT_WEIGHT_NORMAL)
-  ctx.set_font_face(self.kilta_font.get_cairo_font_face())
-  ctx.set_font_size(font_size)
-  ctx.set_source_rgba(0, 0, 0, 1) # foreground font color: black
-
-  # TODO: When it comes time to deal with the y_bearing and whatnot, there
-  # will be a reckoning in this snippet of code... Kerning is probably
-  # screwed as well.
-  dx = 0
-  dy = 0
-  for line_extent in line_extents:
-    line = line_extent[0]
-    extent = line_extent[1]
-    dy += font_size # math.ceil(extent.height) + y_bearing... etc etc
-    ctx.move_to(dx, dy)
-    # NOTE: ctx knows the current pen position which is why I need to
-    # re-layout the line right here again.
-    glyph_line = self.kilta_font.layout_line(ctx, line, font_size)
-    ctx.show_glyphs(glyph_line) # Already glyphs
-    dy += font_vertical_padding
-
-  ctx.stroke()
-
-  # ############################
-  # Prepare an _in memory_ file system and write the image to a file.
-  # ############################
-  memfs = MemoryFS()
-  with memfs.open("translation.png", "wb") as fout:
-    surface.write_to_png(fout)
+# ############################
+# What to tell somebody when rendering their .m command failed.
+def render_failure_response(author_nickname, error):
+  if isinstance(error, mr.RenderQueueFull):
+    return f"**{author_nickname}**: Sorry, I'm too busy to write that " \
+      "right now. Try again in a bit!"
+  if isinstance(error, asyncio.TimeoutError):
+    return f"**{author_nickname}**: Sorry, that took too long to write."
+  return f"**{author_nickname}**: Sorry, something went wrong writing " \
+    "that. Try again!"
 
-  del ctx
-  surface.finish()
-  del surface
+# ############################
+# The done callback of the render cache on disk's work nobody waits for, since
+# otherwise its errors would go unseen.
+def report_disk_render_cache_error(future):
+  if future.cancelled():
+    return
+  error = future.exception()
+  if error is not None:
+    print(f"ERROR: Render cache on disk: {error!r}")
 
-  return memfs
+# ############################
+# Something which changes whenever the file at path does, or None if there
+# isn't one.
+def get_file_state(path):
+  try:
+    st = os.stat(path)
+  except OSError:
+    return None
+  return (st.st_mtime_ns, st.st_size)
 
 # ############################
 def get_nick(message):
@@ -222,6 +217,49 @@ def get_nick(message):
   # type. Figure out the consequences of that.
   return message.author.display_name
 
+# ############################
+# Pick apart a message into a bot command and its argument, or None if it
+# isn't a command.
+def parse_command(content):
+  p = re.compile(r'^\s*[.](?P<cmd>\w+(-\w+)*)\s*(?P<arg>.*)$')
+  query = p.search(content.lower())
+  if not query:
+    return None
+
+  cmd = query.group('cmd')
+  arg = query.group('arg')
+  if arg is not None:
+    arg = arg.strip()
+  return (cmd, arg)
+
+# ############################
+# The romanized text of a .m command that actually gets translated.
+def truncate_m_arg(arg):
+  max_len = 2048 # Just a bad hack to prevent overflow problems...
+  truncated_arg = (arg[:max_len] + '....') if len(arg) > max_len else arg
+  return truncated_arg.strip()
+
+# ############################
+# Wrap translated mastis text into the lines of the image.
+def wrap_mastis(mastis_text):
+  dedented = tw.dedent(mastis_text).strip()
+  # NOTE: It turns out discord will use HTML tags to shrink larger
+  # images (like say of text with mnore columns). So, we keep this at
+  # 40 columns in order to keep the width generally ok for the image
+  # and hopefully there isn't too much shrinking based on height.
+  # I haven't run into any yet, but I'm sure we will at some point.
+  return tw.fill(dedented, width=40)
+
+# ############################
+# What we remember about a .m command so that when its message is edited,
+# we can redo only the parts of the work that changed.
+class MastisEditState:
+  def __init__(self, romanized):
+    # The romanized text we last translated.
+    self.romanized = romanized
+    # A ku.KEditableTransliteration, made when first needed.
+    self.transliteration = None
+
 # ############################
 class MastisBotClient(discord.Client):
   # Inherited API:
@@ -246,32 +284,250 @@ class MastisBotClient(discord.Client):
     intents = discord.Intents.all()
     discord.Client.__init__(self,intents=intents)
     # Herein we set up the ability to get a cairo font face and
-    # how to layout the KiltaFont with kerning, etc.
-    self.kilta_font = kf.KiltaFont(font_path)
+    # how to layout the KiltaFont with kerning, etc. It is loaded in the
+    # background while we log in, see get_kilta_font().
+    self.font_path = font_path
+    self.kilta_font = None
+    self.kilta_font_future = None
+    # The get_file_state() of the font file the KiltaFont was loaded from.
+    self.kilta_font_state = None
+    self.font_watch_task = None
+    # The mr.RenderPool .m commands are rendered in, if any.
+    self.render_pool = None
+    self.render_pool_warm_up_task = None
+    # Key: mr.render_cache_key() of a translation, Value: its PNG bytes
+    self.render_cache = ku.LRUCache(None, RENDER_CACHE_BYTES, \
+      lambda key, png: len(key) + len(png))
+    # When we started connecting, for the startup profile.
+    self.gateway_start = None
+    # Translation is deterministic so the same utterance always gets the
+    # same mastis, which lets us memoize the translations people repeat.
+    self.kilta_tokenizer = \
+      ku.KiltaTokenizer(deterministic=True, memo_size=TRANSLATION_MEMO_SIZE)
+    # Key: A user message id with a .m command, Value: its MastisEditState
+    self.m_edit_states = ku.LRUCache(M_EDIT_STATES)
+    # Key: A user message id, Value: the task waiting to redo its command
+    # after it was edited.
+    self.pending_edits = {}
     # Set up the arhive database
+    start = time.perf_counter()
+    import archive as ardb
     self.archivingp = False
     self.archive_db = ardb.ArchiveDB("kilta_guild_archive.db")
     self.archive_db.open()
     self.archive_db.init()
+    startup_profile.add("DB init", time.perf_counter() - start)
+
+    # Set up the render cache on disk. It opens the first time it is used,
+    # when the one in memory is warmed up, see warm_up_render_cache().
+    import render_cache as rc
+    self.disk_render_cache = \
+      rc.RenderCache(RENDER_CACHE_DIR, RENDER_DISK_CACHE_BYTES)
+    # NOTE: The render cache on disk is only used from its own thread, so its
+    # files and sqlite never hold up the event loop.
+    self.disk_render_cache_executor = \
+      concurrent.futures.ThreadPoolExecutor(1, "disk-render-cache")
+    self.render_cache_warm_up_task = None
+    # The keys of renders found in memory since the render cache on disk was
+    # last told about them.
+    self.render_cache_touches = []
+
+  # ###################################################################
+  # Font Loading
+  # ###################################################################
+
+  # ############################
+  # This runs in a worker thread.
+  def load_kilta_font(self):
+    start = time.perf_counter()
+    import kilta_font as kf
+    kilta_font = kf.KiltaFont(self.font_path)
+    startup_profile.add("font load", time.perf_counter() - start)
+    return kilta_font
+
+  # ############################
+  # Start loading the font in a worker thread, if it isn't already.
+  def start_loading_kilta_font(self):
+    if self.kilta_font_future is None:
+      self.kilta_font_state = get_file_state(self.font_path)
+      self.kilta_font_future = asyncio.get_running_loop().run_in_executor( \
+        None, self.load_kilta_font)
+
+  # ############################
+  # The KiltaFont, waiting for it to finish loading if it hasn't yet.
+  async def get_kilta_font(self):
+    if self.kilta_font is None:
+      self.start_loading_kilta_font()
+      self.kilta_font = await self.kilta_font_future
+    return self.kilta_font
+
+  # ############################
+  # Runs forever, swapping in a new KiltaFont whenever the font file changes.
+  # The file must stay the same for a whole look before it is loaded, so we
+  # don't load a font which is still being copied into place.
+  async def watch_kilta_font(self):
+    await self.get_kilta_font()
+    seen_state = self.kilta_font_state
+    while True:
+      await asyncio.sleep(FONT_WATCH_SECONDS)
+      state = get_file_state(self.font_path)
+      if state is None or state != seen_state:
+        seen_state = state
+        continue
+      if state == self.kilta_font_state:
+        continue
+      self.kilta_font_state = state
+      await self.swap_kilta_font()
+
+  # ############################
+  # Build a whole new KiltaFont from the font file in a worker thread and
+  # then swap it in for the current one. A render already underway holds
+  # onto the old one (and its face, see render_translation()) and finishes
+  # with it, and the old cairo face, and so its FreeType face, is let go once
+  # the last of them is done.
+  async def swap_kilta_font(self):
+    import kilta_font as kf
+    start = time.perf_counter()
+    try:
+      new_font = await asyncio.get_running_loop().run_in_executor( \
+        None, kf.KiltaFont, self.font_path)
+    except Exception as e:
+      print(f"ERROR: Could not load the changed font {self.font_path}, " \
+        f"still using the old one: {e}")
+      return
+
+    old_font = self.kilta_font
+    if new_font.font_hash == old_font.font_hash:
+      new_font.release()
+      return
+
+    self.kilta_font = new_font
+    old_font.release()
+    if self.render_pool is not None:
+      self.render_pool.restart()
+    print(f"Swapped in font {self.font_path} ({new_font.font_hash[:12]}) " \
+      f"in {(time.perf_counter() - start) * 1000.0:.1f} ms")
+
+  # ############################
+  # Start the render pool and its workers, if we render in one.
+  def start_render_pool(self):
+    if RENDER_PROCESSES <= 0:
+      return
+    self.render_pool = mr.RenderPool(self.font_path, RENDER_PROCESSES, \
+      RENDER_QUEUE_DEPTH, RENDER_TIMEOUT_SECONDS)
+    self.render_pool_warm_up_task = \
+      asyncio.create_task(self.warm_up_render_pool())
+
+  # ############################
+  async def warm_up_render_pool(self):
+    start = time.perf_counter()
+    workers = await self.render_pool.warm_up()
+    print(f"Render pool: {workers} worker(s) ready in " \
+      f"{(time.perf_counter() - start) * 1000.0:.1f} ms")
+
+  # ############################
+  # Fill the render cache in memory with what people asked for most before,
+  # so a restart doesn't start cold.
+  async def warm_up_render_cache(self):
+    start = time.perf_counter()
+    try:
+      renders = await asyncio.get_running_loop().run_in_executor( \
+        self.disk_render_cache_executor, \
+        self.disk_render_cache.most_requested, RENDER_CACHE_WARM_UP)
+    except Exception as e:
+      print(f"ERROR: Could not warm up the render cache: {e!r}")
+      return
+    for key, png in reversed(renders):
+      self.render_cache.put(key, png)
+    startup_profile.add(f"render cache warm-up ({len(renders)})", \
+      time.perf_counter() - start)
+
+  # ############################
+  # Render the mastis text to PNG image bytes in the render pool, or right
+  # here if there isn't one, unless we have rendered it already, in which
+  # case it is in memory or on disk.
+  async def render_translation(self, xlate):
+    kilta_font = await self.get_kilta_font()
+    # Keep the font's face in the font registry until we are done, even if
+    # a new font is swapped in while we wait on the caches or the pool.
+    kilta_font.acquire_face()
+    try:
+      return await self.render_translation_with(kilta_font, xlate)
+    finally:
+      kilta_font.release_face()
+
+  # ############################
+  async def render_translation_with(self, kilta_font, xlate):
+    key = mr.render_cache_key(xlate, kilta_font.font_hash)
+    png = self.render_cache.get(key)
+    print(f"   - Render cache: {self.render_cache.stats()}")
+    if png is not None:
+      # So the renders people ask for most don't look unused on disk.
+      self.touch_disk_render_cache(key)
+      return png
+
+    png = await asyncio.get_running_loop().run_in_executor( \
+      self.disk_render_cache_executor, self.disk_render_cache.get, key)
+    if png is not None:
+      self.render_cache.put(key, png)
+      return png
+
+    if self.render_pool is not None:
+      font_hash, png = await self.render_pool.render(xlate)
+      # A worker started since the font file changed, but before we
+      # swapped in the new font, renders with the new one. Keep the image
+      # under the font it really is of.
+      if font_hash != kilta_font.font_hash:
+        key = mr.render_cache_key(xlate, font_hash)
+    else:
+      png = mr.render_translation(kilta_font, xlate)
+      print(f"   - Layout cache: {kilta_font.layout_cache.stats()}")
+    self.render_cache.put(key, png)
+    # Nobody has to wait for the image to be written.
+    self.disk_render_cache_executor.submit(self.disk_render_cache.put, \
+      key, png).add_done_callback(report_disk_render_cache_error)
+    return png
+
+  # ############################
+  # Count the render under key as asked for again in the render cache on
+  # disk, along with the others found in memory in the meantime.
+  def touch_disk_render_cache(self, key):
+    self.render_cache_touches.append(key)
+    if len(self.render_cache_touches) == 1:
+      asyncio.get_running_loop().call_later(RENDER_CACHE_TOUCH_SECONDS, \
+        self.flush_disk_render_cache_touches)
+
+  # ############################
+  def flush_disk_render_cache_touches(self):
+    keys = self.render_cache_touches
+    self.render_cache_touches = []
+    self.disk_render_cache_executor.submit(self.disk_render_cache.touch, \
+      keys).add_done_callback(report_disk_render_cache_error)
 
   # ###################################################################
   # Utility Functions
   # ###################################################################
 
   # ############################
-  # NOTE: This function is on hold for now. Discord doesn't yet allow
-  # editing of attached images which is the primary reason for this
-  # function's existence.
+  # If reply_id is given, the bot's earlier reply with that id is edited in
+  # place (replacing its attachment, if any) instead of sending a new one.
   async def send_or_edit_response(self, initiating_message, response, \
-                    attachment):
+                    attachment, reply_id=None):
+    rmsg = None
+    if reply_id is not None:
+      rmsg = await initiating_message.channel.fetch_message(reply_id)
+
     if attachment:
-      memfs, filename, dfilename = attachment
-      with memfs.open(filename, 'rb') as fin:
-        rmsg = await initiating_message.channel.send(response, \
-          file=discord.File(fin, dfilename))
-      memfs.close()
+      dfile = make_discord_file(attachment)
+      if rmsg:
+        rmsg = await rmsg.edit(content=response, attachments=[dfile])
+      else:
+        rmsg = await initiating_message.channel.send(response, file=dfile)
       return rmsg
 
+    if rmsg:
+      return await rmsg.edit(content=response)
+
     rmsg = await initiating_message.channel.send(response)
     return rmsg
 
@@ -301,6 +557,7 @@ class MastisBotClient(discord.Client):
   async def command_aunka(self, message, arg):
     print(f" [Sending response]")
     author_nickname = get_nick(message)
+    import kilta_date as kd
     kaura, olta, aunka, tun = kd.compute_kilta_date()
     response = f"**{author_nickname}**: Today's aunka is **{aunka}**."
     print(f"   -|{response.rstrip()}")
@@ -312,6 +569,7 @@ class MastisBotClient(discord.Client):
   async def command_date(self, message, arg):
     print(f" [Sending response]")
     author_nickname = get_nick(message)
+    import kilta_date as kd
     kaura, olta, aunka, tun = kd.compute_kilta_date()
     kilta_date = f"{kaura} {olta} {aunka} {tun}"
     response = f"**{author_nickname}**: Today's date is **{kilta_date}**."
@@ -353,10 +611,10 @@ class MastisBotClient(discord.Client):
     response = f"{author_nickname}: Ok!"
     print(f"   -|{response.rstrip()}")
     print( "   -|[image]")
-    # Read the file from the in memory FS and dump it to discord.
-    memfs = do_cairo()
+    # Dump the image to discord.
+    png = do_cairo()
     rmsg = await self.send_or_edit_response(message, response, \
-      (memfs, 'translation.png', 'translation.png'))
+      (png, 'translation.png'))
     print(f"   - Response message id: {rmsg.id}")
     return rmsg
 
@@ -364,30 +622,74 @@ class MastisBotClient(discord.Client):
   async def command_m(self, message, arg):
     print(f" [Sending response]")
     author_nickname = get_nick(message)
-    max_len = 2048 # Just a bad hack to prevent overflow problems...
-    truncated_arg = (arg[:max_len] + '....') if len(arg) > max_len else arg
-
-    kt = ku.KiltaTokenizer()
-
-    mastis_text = kt.romanized_to_mastis(truncated_arg.strip())
-    dedented = tw.dedent(mastis_text).strip()
-    # NOTE: It turns out discord will use HTML tags to shrink larger
-    # images (like say of text with mnore columns). So, we keep this at
-    # 40 columns in order to keep the width generally ok for the image
-    # and hopefully there isn't too much shrinking based on height.
-    # I haven't run into any yet, but I'm sure we will at some point.
-    xlate = tw.fill(dedented, width=40)
+    romanized = truncate_m_arg(arg)
+
+    kt = self.kilta_tokenizer
+
+    mastis_text = kt.romanized_to_mastis(romanized)
+    print(f"   - Translation memo: {kt.memo.stats()}")
+    xlate = wrap_mastis(mastis_text)
     response = f"**{author_nickname}** wrote:\n"
     print(f"   -|{response.rstrip()}")
     print( "   -|[image]")
 
-    # Read the file from the in memory FS and dump it to discord.
-    memfs = do_translate(self, xlate)
+    # Remember what we did so an edit of the message can be redone cheaply.
+    edit_state = MastisEditState(romanized)
+    self.m_edit_states.put(message.id, edit_state)
+
+    try:
+      png = await self.render_translation(xlate)
+    except mr.RENDER_ERRORS as e:
+      print(f"   - Render failed: {e!r}")
+      return await self.send_or_edit_response(message, \
+        render_failure_response(author_nickname, e), None)
+
+    # Dump the image to discord.
     rmsg = await self.send_or_edit_response(message, response, \
-      (memfs, 'translation.png', 'translation.png'))
+      (png, 'translation.png'))
     print(f"   - Response message id: {rmsg.id}")
     return rmsg
 
+  # ############################
+  # Redo a .m command whose message was edited, editing our reply to it
+  # in place. Only the changed part of the utterance is translated again,
+  # and it comes out the same as a .m of the edited message would, so a
+  # render of it already in the caches is reused.
+  async def command_m_edited(self, message, arg, reply_id, before_arg):
+    print(f" [Editing response {reply_id}]")
+    author_nickname = get_nick(message)
+    romanized = truncate_m_arg(arg)
+
+    # If we've forgotten about the message, start from what it was before.
+    edit_state = self.m_edit_states.get(message.id)
+    if edit_state is None:
+      edit_state = MastisEditState(truncate_m_arg(before_arg or ""))
+      self.m_edit_states.put(message.id, edit_state)
+
+    if edit_state.transliteration is None:
+      edit_state.transliteration = \
+        self.kilta_tokenizer.transliterate_editable(edit_state.romanized)
+    scanned = edit_state.transliteration.edit(romanized)
+    edit_state.romanized = romanized
+    print(f"   - Rescanned {scanned} token(s)")
+
+    xlate = wrap_mastis(edit_state.transliteration.mastis())
+    response = f"**{author_nickname}** wrote:\n"
+    print(f"   -|{response.rstrip()}")
+    print( "   -|[image]")
+
+    try:
+      png = await self.render_translation(xlate)
+    except mr.RENDER_ERRORS as e:
+      print(f"   - Render failed: {e!r}")
+      return await self.send_or_edit_response(message, \
+        render_failure_response(author_nickname, e), None, reply_id)
+
+    rmsg = await self.send_or_edit_response(message, response, \
+      (png, 'translation.png'), reply_id)
+    print(f"   - Edited response message id: {rmsg.id}")
+    return rmsg
+
   # ############################
   async def command_test_history(self, message, arg):
     # Get a time 10 years go from today.
@@ -435,6 +737,8 @@ class MastisBotClient(discord.Client):
   async def periodic_archive(self, guild, seconds, channels_to_backup):
     print(f"Channels expected to be backed up: {channels_to_backup}")
 
+    import pytz
+    import archive as ardb
     central_timezone = pytz.timezone('America/Chicago')
     all_channels = [ channel for channel in guild.channels ]
 
@@ -556,12 +860,28 @@ class MastisBotClient(discord.Client):
   # Discord Client Interface
   # ###################################################################
 
+  # ############################
+  # Called after logging in but before connecting to the gateway, so the
+  # font loads while the rest of the handshake happens.
+  async def setup_hook(self):
+    self.start_loading_kilta_font()
+    self.start_render_pool()
+    self.render_cache_warm_up_task = \
+      asyncio.create_task(self.warm_up_render_cache())
+    self.font_watch_task = asyncio.create_task(self.watch_kilta_font())
+
   # ############################
   async def on_ready(self):
     # Archive every 4 hours.
     periodic_archive_seconds = 60 * 60 * 4
 
     print(f"self.user: {self.user} is ready!")
+    if startup_profile.enabled and self.gateway_start is not None:
+      startup_profile.add("gateway ready", \
+        time.perf_counter() - self.gateway_start)
+      self.gateway_start = None
+      await self.get_kilta_font()
+      print(startup_profile.report())
 
     guild = discord.utils.get(self.guilds, name = GUILD_NAME)
     if not guild:
@@ -622,6 +942,10 @@ class MastisBotClient(discord.Client):
     val = self.bot_replies.pop(message.id, None)
     if val:
       print(f"%-> Removed message from cache: {message.id} -/-> {val}!")
+    self.m_edit_states.pop(message.id)
+    task = self.pending_edits.pop(message.id, None)
+    if task:
+      task.cancel()
   
   # TODO: Handle bulk message deletes later.
 
@@ -631,17 +955,43 @@ class MastisBotClient(discord.Client):
     if before.author == self.user or after.author == self.user:
       return
 
-    # TODO: Keep track of the message ids that contained xlate commands and
-    # the messages I generated in response to it. If the original message
-    # changed, then attempt to edit the message I originally sent in place
-    # with the new translations.
-
     print("-- Message edited:")
     print(f" Before: ({before.author.display_name}, msg id: {before.id})")
     print(f"  - {before.content}")
     print(f" After: ({after.author.display_name}, msg id: {after.id})")
     print(f"  - {after.content}")
 
+    # If the edited message was a command we replied to, redo it by editing
+    # our reply in place. We wait a bit first and start the wait over on
+    # every edit, so only the final state of a burst of edits is redone.
+    reply_id = self.bot_replies.get(after.id)
+    if reply_id is None or before.content == after.content:
+      return
+
+    task = self.pending_edits.pop(after.id, None)
+    if task:
+      task.cancel()
+    self.pending_edits[after.id] = \
+      asyncio.create_task(self.redo_edited_command(before, after, reply_id))
+
+  # ############################
+  async def redo_edited_command(self, before, after, reply_id):
+    try:
+      await asyncio.sleep(EDIT_DEBOUNCE_SECONDS)
+
+      query = parse_command(after.content)
+      if not query or query[0] != "m":
+        print(f" [Edit of {after.id} is not a .m command. Doing nothing!]")
+        return
+      cmd, arg = query
+
+      before_query = parse_command(before.content)
+      before_arg = before_query[1] if before_query else None
+      await self.command_m_edited(after, arg, reply_id, before_arg)
+    finally:
+      if self.pending_edits.get(after.id) is asyncio.current_task():
+        del self.pending_edits[after.id]
+
   # ############################
   async def on_message(self, message):
     # Ensure that the bot cannot reply to itself!
@@ -666,19 +1016,12 @@ class MastisBotClient(discord.Client):
     print(f" - content: '{message.content}'")
 
     # See if the message is a command to the bot...
-    p = re.compile(r'^\s*[.](?P<cmd>\w+(-\w+)*)\s*(?P<arg>.*)$')
-    query = p.search(message.content.lower())
+    query = parse_command(message.content)
     if not query:
       print(" [No query detected. Doing nothing!]")
       return
 
-    cmd = query.group('cmd')
-    arg = query.group('arg')
-    if arg is not None:
-      arg = arg.strip()
-  
-    if not query:
-      return
+    cmd, arg = query
 
     if cmd == "help":
       rmsg = await self.command_help(message, arg)
@@ -723,10 +1066,82 @@ class MastisBotClient(discord.Client):
     else:
       print("%-> No reply to add to cache!")
 
+# ############################
+# The font swap test: change the font file and swap it in while a render
+# waits on the render cache on disk, and make sure the render still finishes
+# with the old font and lets go of its face once it has. Runs in a scratch
+# directory so it leaves no archive or render cache behind.
+async def do_font_swap_test(font_path):
+  import shutil
+  import tempfile
+  import threading
+  import font_helper as fh
+  import render_cache as rc
+
+  cwd = os.getcwd()
+  with tempfile.TemporaryDirectory() as scratch:
+    os.chdir(scratch)
+    try:
+      test_font_path = os.path.join(scratch, os.path.basename(font_path))
+      shutil.copyfile(font_path, test_font_path)
+      client = MastisBotClient(test_font_path)
+      client.disk_render_cache = rc.RenderCache( \
+        os.path.join(scratch, "render_cache"), RENDER_DISK_CACHE_BYTES)
+      old_font = await client.get_kilta_font()
+
+      # Hold up the render cache on disk, so the render waits on it.
+      go = threading.Event()
+      client.disk_render_cache_executor.submit(go.wait)
+      render = asyncio.create_task(client.render_translation("kiu\nsa"))
+      await asyncio.sleep(0.1)
+
+      # Trailing bytes change the font's hash without changing the font.
+      with open(test_font_path, "ab") as f:
+        f.write(b"\0" * 4)
+      await client.swap_kilta_font()
+      swapped = client.kilta_font is not old_font
+      go.set()
+      try:
+        png = await render
+      except Exception as e:
+        print(f"ERROR! The render failed after the swap: {e!r}")
+        png = None
+      refcount = fh.registry.refcount(test_font_path, \
+        generation=old_font.font_hash)
+      client.disk_render_cache_executor.shutdown(wait=True)
+      client.kilta_font.release()
+      client.disk_render_cache.close()
+      client.archive_db.close()
+    finally:
+      os.chdir(cwd)
+
+  passed = swapped and png is not None and refcount == 0
+  if not swapped:
+    print("ERROR! The changed font wasn't swapped in.")
+  if refcount != 0:
+    print(f"ERROR! The old font's face is still held {refcount} time(s).")
+  print(f"Font swap test: {'passed' if passed else 'FAILED'}.")
+  return passed
+
 # ############################
 def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--startup-profile", \
+    help="Print how long each phase of starting up took once ready", \
+    action="store_true")
+  parser.add_argument("-t", "--test", \
+    help="Run the font swap test instead of the bot", \
+    action="store_true")
+  # NOTE: The mastis_bot script passes along options which aren't ours.
+  args, unknown = parser.parse_known_args()
+  startup_profile.enabled = args.startup_profile
+
+  if args.test:
+    return 0 if asyncio.run(do_font_swap_test(MASTIS_FONT)) else 1
+
   print("Starting mastis_bot...")
   client = MastisBotClient(MASTIS_FONT)
+  client.gateway_start = time.perf_counter()
   client.run(TOKEN)
   return 0
 
@@ -0,0 +1,336 @@
+# Rendering mastis to PNG images, either right here or in a pool of worker
+# processes which each load the KiltaFont once, so big renders don't hold
+# up the bot's event loop and many of them can run at once.
+
+import io
+import os
+import hashlib
+import math
+import asyncio
+import concurrent.futures
+import concurrent.futures.process
+import multiprocessing
+
+# How translations look. Colors are (r, g, b, a).
+FONT_SIZE = 30
+FOREGROUND = (0.0, 0.0, 0.0, 1.0) # black
+BACKGROUND = (1.0, 1.0, 1.0, 1.0) # white
+
+# How translations are written: "rgba" is the full color PNG cairo writes
+# itself, otherwise it is one of the png_writer.PNG_MODES written with
+# the zlib compression level, 0 (fastest) to 9 (smallest).
+# NOTE: png_writer, and so NumPy, is only imported once there is a PNG to
+# write, so as not to slow down starting up; keep these in step with its
+# PNG_MODES.
+PNG_MODES = ("rgba", "palette", "palette4", "gray", "1bit")
+PNG_MODE = os.getenv("MASTIS_PNG_MODE", "palette")
+PNG_COMPRESSION = int(os.getenv("MASTIS_PNG_COMPRESSION", 6))
+if PNG_MODE not in PNG_MODES:
+  raise ValueError(f"Unknown MASTIS_PNG_MODE: {PNG_MODE}")
+
+# What draws translations in the png_writer modes: "atlas" composites glyphs
+# cairo rasterized once ahead of time out of the font's glyph_atlas.GlyphAtlas,
+# "cairo" has cairo draw every one. The "rgba" mode is always drawn by cairo.
+RENDERER = os.getenv("MASTIS_RENDERER", "atlas")
+if RENDERER not in ("atlas", "cairo"):
+  raise ValueError(f"Unknown MASTIS_RENDERER: {RENDERER}")
+
+# ############################
+# What identifies the PNG image render_translation() makes of msg with a
+# font (by its hash), size, colors, PNG format, and renderer, as a hash.
+# Since translation is deterministic, the same utterance always gets the
+# same key.
+def render_cache_key(msg, font_hash, font_size=FONT_SIZE, \
+                     foreground=FOREGROUND, background=BACKGROUND, \
+                     png_mode=PNG_MODE, png_compression=PNG_COMPRESSION, \
+                     renderer=RENDERER):
+  if png_mode == "rgba":
+    renderer = "cairo"
+  key = repr((msg, font_hash, font_size, foreground, background, png_mode, \
+              png_compression, renderer))
+  return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+# ############################
+# Render the lines of msg, which is mastis, with the KiltaFont and return the
+# PNG image of it as bytes.
+def render_translation(kilta_font, msg, font_size=FONT_SIZE, \
+                       foreground=FOREGROUND, background=BACKGROUND, \
+                       png_mode=PNG_MODE, png_compression=PNG_COMPRESSION, \
+                       renderer=RENDERER):
+  coverage = png_mode != "rgba"
+  if coverage and renderer == "atlas":
+    import png_writer as pw
+    rows = composite_translation(kilta_font, msg, font_size)
+    height, width = rows.shape
+    return pw.encode_coverage_png(rows, width, height, width, foreground, \
+      background, png_mode, png_compression)
+
+  surface = draw_translation(kilta_font, msg, font_size, foreground, \
+    background, coverage)
+  png = encode_translation(surface, foreground, background, png_mode, \
+    png_compression)
+  surface.finish()
+  return png
+
+# ############################
+# Lay out the lines of msg, which is mastis, with the KiltaFont and work out
+# the size of the image they fit in. Returns (runs, width, height) where
+# runs is [(glyphs, (x, y)), ...], the glyphs of each line laid out against
+# the origin and the pen position to draw them at. The font remembers the
+# lines it has laid out recently, so the lines people repeat, or leave alone
+# while editing a message, are nearly free to lay out.
+def layout_translation(kilta_font, msg, font_size=FONT_SIZE):
+  # fixed width assumption, or at least maximum constraint
+  font_vertical_padding = 3
+  lines = msg.splitlines()
+
+  # ############################
+  # Lay out every line against the origin. The layout knows the ink and
+  # advance extents of the line straight from the font's metrics, so
+  # nothing has to be drawn to measure it. The lines get moved into place
+  # when rendering.
+  # ############################
+  line_layouts = [kilta_font.layout(line, font_size) for line in lines]
+
+  # font_extents is (ascent, descent, height, max_x_advance, max_y_advance)
+  font_extents = kilta_font.get_font_extents(font_size)
+
+  # ############################
+  # Compute the correct size of the surface.
+  # ############################
+  WIDTH = 0
+  HEIGHT = 0
+  for line_layout in line_layouts:
+    extent = line_layout.extents
+    # The ink of the last glyph may stick out past the pen, or not reach it.
+    WIDTH = max(math.ceil(max(extent.x_advance, \
+                              extent.x_bearing + extent.width)), WIDTH)
+    # TODO: Computation of height needs a reckoning.
+    HEIGHT += max(font_size, math.ceil(extent.height)) + \
+          font_vertical_padding
+  WIDTH = max(WIDTH, 1)
+  # ..and add font's average descent to entail the last line's descenders.
+  HEIGHT = math.ceil(HEIGHT + font_extents[1])
+
+  # TODO: When it comes time to deal with the y_bearing and whatnot, there
+  # will be a reckoning in this snippet of code... Kerning is probably
+  # screwed as well.
+  runs = []
+  dx = 0
+  dy = 0
+  for line_layout in line_layouts:
+    dy += font_size # math.ceil(extent.height) + y_bearing... etc etc
+    runs.append((line_layout.glyphs, (dx, dy)))
+    dy += font_vertical_padding
+
+  return runs, WIDTH, HEIGHT
+
+# ############################
+# Draw the lines of msg, which is mastis, with the KiltaFont onto a new
+# cairo surface just large enough for them and return it.
+#
+# If coverage is true, the surface is FORMAT_A8 and only holds how much of
+# each pixel the glyphs cover, which is all png_writer needs to write the
+# image in the two colors. Otherwise it is FORMAT_ARGB32 with the colors.
+def draw_translation(kilta_font, msg, font_size=FONT_SIZE, \
+                     foreground=FOREGROUND, background=BACKGROUND, \
+                     coverage=False):
+  import cairo
+
+  runs, WIDTH, HEIGHT = layout_translation(kilta_font, msg, font_size)
+
+  # ############################
+  # Now finally we can reallocate a new surface that is exactly what we need
+  # to draw the text.
+  # ############################
+
+  if coverage:
+    surface = cairo.ImageSurface(cairo.FORMAT_A8, WIDTH, HEIGHT)
+    ctx = cairo.Context(surface)
+  else:
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, WIDTH, HEIGHT)
+    ctx = cairo.Context(surface)
+
+    ctx.set_source_rgba(*background)
+    ctx.rectangle(0, 0, WIDTH, HEIGHT)
+    ctx.fill()
+
+  # ############################
+  # And finally render the text!
+  # ############################
+  #ctx.select_font_face("DejaVu Sans Mono", cairo.FONT_SLANT_NORMAL, \
+  #  cairo.FONT_WEIGHT_NORMAL)
+  # The scaled font is prebuilt and shared by every render at this size.
+  ctx.set_scaled_font(kilta_font.get_scaled_font(font_size))
+  if coverage:
+    ctx.set_source_rgba(0, 0, 0, 1) # only the alpha lands on the surface
+  else:
+    ctx.set_source_rgba(*foreground)
+
+  for glyphs, (dx, dy) in runs:
+    # NOTE: The line was laid out at the origin, so move it into place.
+    ctx.save()
+    ctx.translate(dx, dy)
+    ctx.show_glyphs(glyphs) # Already glyphs
+    ctx.restore()
+
+  ctx.stroke()
+
+  del ctx
+  surface.flush()
+  return surface
+
+# ############################
+# The same as draw_translation() with coverage, but the glyphs are copied out
+# of the font's glyph atlas at font_size, which is made the first time it is
+# needed, and the coverage is returned as a (height, width) array of bytes.
+def composite_translation(kilta_font, msg, font_size=FONT_SIZE):
+  runs, WIDTH, HEIGHT = layout_translation(kilta_font, msg, font_size)
+  return kilta_font.get_glyph_atlas(font_size).composite(runs, WIDTH, HEIGHT)
+
+# ############################
+# Write a surface from draw_translation() as PNG bytes in the png_mode.
+def encode_translation(surface, foreground=FOREGROUND, background=BACKGROUND, \
+                       png_mode=PNG_MODE, png_compression=PNG_COMPRESSION):
+  if png_mode != "rgba":
+    import png_writer as pw
+    return pw.encode_coverage_png(surface.get_data(), surface.get_width(), \
+      surface.get_height(), surface.get_stride(), foreground, background, \
+      png_mode, png_compression)
+
+  # Write the image once to an in memory file. Taking its value after that
+  # doesn't copy it, the bytes object the file grew into is handed over.
+  fout = io.BytesIO()
+  surface.write_to_png(fout)
+  return fout.getvalue()
+
+
+# ############################
+# The render pool is too busy to take another render.
+class RenderQueueFull(Exception):
+  pass
+
+# ############################
+# What RenderPool.render() raises when it couldn't render: it was too busy,
+# it took too long, or a worker died while rendering.
+RENDER_ERRORS = (RenderQueueFull, asyncio.TimeoutError, \
+  concurrent.futures.process.BrokenProcessPool)
+
+# ############################
+# In a worker process, the KiltaFont every render uses.
+worker_kilta_font = None
+
+# ############################
+# The initializer of every worker process.
+def init_render_worker(font_path):
+  global worker_kilta_font
+  import kilta_font as kf
+  worker_kilta_font = kf.KiltaFont(font_path)
+  # Rasterize the glyphs now, while the pool is warming up, rather than in
+  # the first render.
+  if PNG_MODE != "rgba" and RENDERER == "atlas":
+    worker_kilta_font.get_glyph_atlas(FONT_SIZE)
+
+# ############################
+# Render in a worker and return (font_hash, png). The font is whatever was in
+# the font file when the worker started, which may not be the version the
+# bot has (yet), so the hash says which one the image is of.
+def render_in_worker(msg):
+  return worker_kilta_font.font_hash, \
+    render_translation(worker_kilta_font, msg)
+
+# ############################
+def ping_worker():
+  return os.getpid()
+
+# ############################
+# A pool of processes rendering mastis with the font at font_path. At most
+# max_queued renders may be waiting or underway at once, and a render taking
+# longer than timeout seconds is given up on, though it still counts as
+# underway until its worker finishes it.
+class RenderPool:
+  def __init__(self, font_path, processes, max_queued, timeout):
+    self.font_path = font_path
+    self.processes = processes
+    self.max_queued = max_queued
+    self.timeout = timeout
+    # How many renders are waiting or underway right now.
+    self.queued = 0
+    self.executor = None
+    self.start()
+
+  # ############################
+  # NOTE: The workers aren't forked from the bot, since it has threads
+  # running by the time the pool starts. They are forked from a fork server
+  # instead, which has already imported what rendering needs, so a worker
+  # starts, or restarts after the font changes, without importing it all
+  # again. Where there is no fork server they are spawned.
+  def start(self):
+    if "forkserver" in multiprocessing.get_all_start_methods():
+      context = multiprocessing.get_context("forkserver")
+      context.set_forkserver_preload(["mastis_render", "kilta_font"])
+    else:
+      context = multiprocessing.get_context("spawn")
+    self.executor = concurrent.futures.ProcessPoolExecutor( \
+      self.processes, mp_context=context, \
+      initializer=init_render_worker, initargs=(self.font_path,))
+
+  # ############################
+  # Start every worker and have it load the font now, instead of during the
+  # first renders.
+  async def warm_up(self):
+    loop = asyncio.get_running_loop()
+    executor = self.executor
+    pids = await asyncio.gather( \
+      *[loop.run_in_executor(executor, ping_worker) \
+          for i in range(self.processes)])
+    return len(set(pids))
+
+  # ############################
+  # Replace the workers with new ones which load the font again, say after
+  # it changed. Renders underway finish with the old workers, which exit
+  # once they are done.
+  def restart(self):
+    old_executor = self.executor
+    self.start()
+    old_executor.shutdown(wait=False)
+
+  # ############################
+  # Render the mastis msg in a worker and return (font_hash, png) where png
+  # is the PNG image as bytes and font_hash that of the font it used.
+  # Raises RenderQueueFull if too many renders are already waiting,
+  # asyncio.TimeoutError if it takes too long, and BrokenProcessPool if the
+  # worker died.
+  async def render(self, msg):
+    if self.queued >= self.max_queued:
+      raise RenderQueueFull(f"{self.queued} renders already queued")
+
+    loop = asyncio.get_running_loop()
+    executor = self.executor
+    try:
+      future = executor.submit(render_in_worker, msg)
+      # NOTE: A render we gave up waiting for still keeps its worker busy,
+      # so it counts until the worker is really done with it (or it is
+      # cancelled before a worker picks it up). The callback runs in the
+      # executor's thread.
+      self.queued += 1
+      def done(future):
+        if not loop.is_closed():
+          loop.call_soon_threadsafe(self.render_done)
+      future.add_done_callback(done)
+      return await asyncio.wait_for(asyncio.wrap_future(future), \
+        self.timeout)
+    except concurrent.futures.process.BrokenProcessPool:
+      # A worker died, so start over with new ones for the next render,
+      # unless another render already did.
+      if executor is self.executor:
+        self.restart()
+      raise
+
+  # ############################
+  def render_done(self):
+    self.queued -= 1
+
+  # ############################
+  def shutdown(self):
+    self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,98 @@
+# A small PNG encoder for images which are just one color over another, like
+# mastis glyphs over a background. The image is given as the coverage of
+# the foreground color at each pixel, 0 to 255, in the layout of a cairo
+# FORMAT_A8 surface, and it is written as a palettized (or grayscale) PNG,
+# which is a fraction of the size of the full RGBA one cairo writes.
+
+import struct
+import zlib
+import numpy as np
+
+# How each pixel is written:
+#   palette: 8 bits indexing 256 colors between the background and the
+#            foreground, so nothing of the coverage is lost.
+#   palette4: 4 bits indexing 16 of those colors.
+#   gray: 8 bits of gray, the luminance of the 256 colors.
+#   1bit: 1 bit, the foreground where the coverage is at least half.
+PNG_MODES = ("palette", "palette4", "gray", "1bit")
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# PNG color types
+PNG_GRAY = 0
+PNG_INDEXED = 3
+
+# ############################
+def png_chunk(chunk_type, data):
+  return struct.pack(">I", len(data)) + chunk_type + data + \
+    struct.pack(">I", zlib.crc32(chunk_type + data))
+
+# ############################
+# The levels colors between background and foreground, each (r, g, b, a)
+# in [0, 1], as a (levels, 4) array of bytes.
+def interpolate_colors(background, foreground, levels):
+  t = np.linspace(0.0, 1.0, levels)[:, np.newaxis]
+  bg = np.array(background, dtype=np.float64)
+  fg = np.array(foreground, dtype=np.float64)
+  return np.rint((bg + (fg - bg) * t) * 255.0).astype(np.uint8)
+
+# ############################
+# The rows of coverage with stride bytes between them, as a (height, width)
+# array of bytes, without copying them.
+def coverage_rows(coverage, width, height, stride):
+  rows = np.frombuffer(coverage, dtype=np.uint8, count=stride * height)
+  return rows.reshape(height, stride)[:, :width]
+
+# ############################
+# Encode the coverage of foreground over background as PNG bytes in one of
+# the PNG_MODES. The compression level is zlib's, from 0 (fastest) to 9
+# (smallest).
+def encode_coverage_png(coverage, width, height, stride, foreground, \
+                        background, mode="palette", level=6):
+  rows = coverage_rows(coverage, width, height, stride)
+  chunks = []
+
+  if mode == "palette" or mode == "palette4":
+    bit_depth = 8 if mode == "palette" else 4
+    colors = interpolate_colors(background, foreground, 1 << bit_depth)
+    color_type = PNG_INDEXED
+    if bit_depth == 8:
+      samples = rows
+    else:
+      # Round the coverage to the nearest of the 16 levels and pack two
+      # pixels to a byte, the first in the high nibble.
+      levels = (rows.astype(np.uint16) * 15 + 127) // 255
+      if width % 2:
+        levels = np.pad(levels, ((0, 0), (0, 1)))
+      samples = ((levels[:, 0::2] << 4) | levels[:, 1::2]).astype(np.uint8)
+  elif mode == "1bit":
+    bit_depth = 1
+    colors = interpolate_colors(background, foreground, 2)
+    color_type = PNG_INDEXED
+    samples = np.packbits(rows >= 128, axis=1)
+  elif mode == "gray":
+    bit_depth = 8
+    colors = None
+    color_type = PNG_GRAY
+    rgb = interpolate_colors(background, foreground, 256)[:, :3]
+    luminance = np.rint(rgb @ np.array([0.2126, 0.7152, 0.0722]))
+    samples = luminance.astype(np.uint8)[rows]
+  else:
+    raise ValueError(f"Unknown PNG mode: {mode}")
+
+  chunks.append(png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, \
+    bit_depth, color_type, 0, 0, 0)))
+  if colors is not None:
+    chunks.append(png_chunk(b"PLTE", colors[:, :3].tobytes()))
+    # Only say how transparent the colors are if any of them are.
+    if (colors[:, 3] != 255).any():
+      chunks.append(png_chunk(b"tRNS", colors[:, 3].tobytes()))
+
+  # Every row starts with its filter type, always 0 (None) here, since the
+  # flat runs of text images compress well enough as they are.
+  raw = np.zeros((height, samples.shape[1] + 1), dtype=np.uint8)
+  raw[:, 1:] = samples
+  chunks.append(png_chunk(b"IDAT", zlib.compress(raw.tobytes(), level)))
+  chunks.append(png_chunk(b"IEND", b""))
+
+  return PNG_SIGNATURE + b"".join(chunks)
@@ -0,0 +1,207 @@
+#! /usr/bin/env python3
+
+import os
+import sqlite3
+import time
+
+# A content addressed store of rendered PNG images on disk, which survives
+# restarts and may be shared by any number of processes at once.
+#
+# Each image is a file named by its key in a directory of files (spread over
+# subdirectories by the first two characters of the key), and a sqlite
+# index in the same directory remembers the size of each one, how often it
+# was asked for, and when it was last used. Files are written to a
+# temporary file and renamed into place, so a reader only ever sees whole
+# images, and the index is in WAL mode so readers and writers don't block
+# each other. When the images take more than max_bytes, the least recently
+# used ones are thrown away. That is only looked into once every
+# max_bytes / EVICT_FRACTION bytes written, so the images may take a little
+# more than max_bytes for a while.
+#
+# NOTE: A RenderCache may be used from any thread, but only from one at a
+# time.
+
+# What fraction of max_bytes has to be written before evict() is run again.
+EVICT_FRACTION = 64
+
+class RenderCache:
+  sql_create_table_render = '''
+    CREATE TABLE IF NOT EXISTS render (
+      key TEXT NOT NULL,
+      size INTEGER NOT NULL,
+      hits INTEGER NOT NULL,
+      last_used REAL NOT NULL,
+      PRIMARY KEY (key)
+    )
+    '''
+  sql_create_index_last_used = '''
+    CREATE INDEX IF NOT EXISTS render_last_used ON render (last_used)
+    '''
+  sql_create_index_hits = '''
+    CREATE INDEX IF NOT EXISTS render_hits ON render (hits)
+    '''
+  sql_insert_or_update_render = '''
+    INSERT INTO render(key, size, hits, last_used)
+      VALUES(?, ?, 0, ?)
+      ON CONFLICT(key)
+        DO UPDATE SET size=excluded.size, last_used=excluded.last_used
+    '''
+  sql_update_render_hit = '''
+    UPDATE render SET hits=hits + 1, last_used=? WHERE key = ?
+    '''
+  sql_delete_render = '''
+    DELETE FROM render WHERE key = ?
+    '''
+  sql_select_total_size = '''
+    SELECT COALESCE(SUM(size), 0) FROM render
+    '''
+  sql_select_least_recently_used = '''
+    SELECT key, size FROM render ORDER BY last_used ASC LIMIT ?
+    '''
+  sql_select_most_requested = '''
+    SELECT key FROM render ORDER BY hits DESC, last_used DESC LIMIT ?
+    '''
+
+  # ############################
+  def __init__(self, directory="kilta_render_cache", \
+               max_bytes=512 * 1024 * 1024):
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self.conn = None
+    self.cursor = None
+    self.hits = 0
+    self.misses = 0
+    # Bytes put since the total size was last looked at.
+    self.unchecked_bytes = 0
+
+  # ############################
+  def open(self):
+    # Open only once.
+    if self.conn == None:
+      os.makedirs(self.directory, exist_ok=True)
+      # NOTE: Autocommit, since every statement stands on its own, and wait
+      # a while for other processes holding the write lock.
+      self.conn = sqlite3.connect(os.path.join(self.directory, "index.db"), \
+        timeout=30, isolation_level=None, check_same_thread=False)
+      self.cursor = self.conn.cursor()
+      self.cursor.execute("PRAGMA journal_mode=WAL")
+      self.cursor.execute(self.sql_create_table_render)
+      self.cursor.execute(self.sql_create_index_last_used)
+      self.cursor.execute(self.sql_create_index_hits)
+
+  # ############################
+  def path(self, key):
+    return os.path.join(self.directory, key[:2], f"{key}.png")
+
+  # ############################
+  # Return the PNG bytes stored under key, or None.
+  def get(self, key):
+    self.open()
+    try:
+      with open(self.path(key), "rb") as f:
+        png = f.read()
+    except FileNotFoundError:
+      # Never stored, or evicted by somebody else.
+      self.cursor.execute(self.sql_delete_render, (key,))
+      self.misses += 1
+      return None
+
+    self.cursor.execute(self.sql_update_render_hit, (time.time(), key))
+    self.hits += 1
+    return png
+
+  # ############################
+  def put(self, key, png):
+    self.open()
+    path = self.path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # Write then rename, so nobody ever reads half an image.
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+      with open(tmp_path, "wb") as f:
+        f.write(png)
+      os.replace(tmp_path, path)
+    finally:
+      if os.path.exists(tmp_path):
+        os.unlink(tmp_path)
+
+    self.cursor.execute(self.sql_insert_or_update_render, \
+      (key, len(png), time.time()))
+    self.unchecked_bytes += len(png)
+    if self.unchecked_bytes >= self.max_bytes // EVICT_FRACTION:
+      self.evict()
+
+  # ############################
+  # Count the images stored under keys as asked for again now, without
+  # reading them, for when they were found somewhere else first, like a
+  # cache in memory. Keys which aren't stored are ignored.
+  def touch(self, keys):
+    self.open()
+    now = time.time()
+    self.cursor.execute("BEGIN")
+    try:
+      self.cursor.executemany(self.sql_update_render_hit, \
+        [(now, key) for key in keys])
+    except BaseException:
+      self.cursor.execute("ROLLBACK")
+      raise
+    self.cursor.execute("COMMIT")
+
+  # ############################
+  # Throw away the least recently used images until they all fit in
+  # max_bytes again.
+  def evict(self):
+    self.open()
+    self.unchecked_bytes = 0
+    self.cursor.execute(self.sql_select_total_size)
+    total = self.cursor.fetchone()[0]
+    while total > self.max_bytes:
+      self.cursor.execute(self.sql_select_least_recently_used, (64,))
+      rows = self.cursor.fetchall()
+      if len(rows) == 0:
+        break
+      for key, size in rows:
+        if total <= self.max_bytes:
+          break
+        self.cursor.execute(self.sql_delete_render, (key,))
+        try:
+          os.unlink(self.path(key))
+        except FileNotFoundError:
+          pass
+        total -= size
+
+  # ############################
+  # Return [(key, png), ...] of the count most requested images, for
+  # warming up a cache in memory.
+  def most_requested(self, count):
+    self.open()
+    self.cursor.execute(self.sql_select_most_requested, (count,))
+    keys = [row[0] for row in self.cursor.fetchall()]
+    renders = []
+    for key in keys:
+      try:
+        with open(self.path(key), "rb") as f:
+          renders.append((key, f.read()))
+      except FileNotFoundError:
+        pass
+    return renders
+
+  # ############################
+  def stats(self):
+    self.open()
+    self.cursor.execute(self.sql_select_total_size)
+    lookups = self.hits + self.misses
+    return {
+      'bytes': self.cursor.fetchone()[0],
+      'hits': self.hits,
+      'misses': self.misses,
+      'hit_rate': self.hits / lookups if lookups else 0.0,
+    }
+
+  # ############################
+  def close(self):
+    if self.conn != None:
+      self.conn.close()
+      self.conn = None
+      self.cursor = None